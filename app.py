@@ -1,20 +1,55 @@
+import time
+_SCRIPT_START = time.perf_counter()
+
 import streamlit as st
 import json
 import os
 import datetime
-import time
-import google.generativeai as genai
-import pandas as pd
-from supabase import create_client, Client
+import sys
+import threading
+import importlib
+import hashlib
+import collections
+import random
+import csv
+import sqlite3
+import contextlib
+import re
+import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Supabase client
-supabase_url = os.getenv("SUPABASE_URL") 
-supabase_key = os.getenv("SUPABASE_KEY")
-supabase = create_client(supabase_url, supabase_key)
+# Process-wide startup profile: step name -> seconds, filled on first use
+@st.cache_resource(show_spinner=False)
+def _startup_profile():
+    return {}
+
+_startup_profile().setdefault("app imports", time.perf_counter() - _SCRIPT_START)
+
+def _profiled(name, loader):
+    start = time.perf_counter()
+    result = loader()
+    _startup_profile()[name] = time.perf_counter() - start
+    return result
+
+# Heavy modules (pandas, google.ai.generativelanguage, supabase) are imported on first use
+def lazy_import(module_name):
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    return _profiled(f"import {module_name}", lambda: importlib.import_module(module_name))
+
+# Supabase client is created on the first database call, not at import time
+@st.cache_resource(show_spinner=False)
+def get_supabase():
+    supabase_module = lazy_import("supabase")
+    return _profiled(
+        "supabase client",
+        lambda: supabase_module.create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    )
 
 # Initialize session state for API key and user info
 if 'api_key' not in st.session_state:
@@ -27,30 +62,25 @@ if 'user_name' not in st.session_state:
 # File path for quiz data only (this is still needed)
 DATA_FILE = "data.json"
 
+# Approximate per-session memory budget (bytes) for st.session_state
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET", 512 * 1024))
+
+# Session keys that can be dropped and rebuilt on demand when over budget
+EVICTABLE_SESSION_PREFIXES = ("explanation_",)
+
 # Function to check if tables exist and create them if needed
 def create_tables_if_needed():
     """Check if tables exist and create them if needed using the Supabase API"""
     try:
-        # First check if the users table exists by trying to query it
-        try:
-            supabase.table('users').select('*').limit(1).execute()
-            users_exists = True
-        except Exception:
-            users_exists = False
-            
-        # Check if quiz_history table exists
-        try:
-            supabase.table('quiz_history').select('*').limit(1).execute()
-            history_exists = True
-        except Exception:
-            history_exists = False
-            
-        # Check if explanations table exists
-        try:
-            supabase.table('explanations').select('*').limit(1).execute()
-            explanations_exists = True
-        except Exception:
-            explanations_exists = False
+        # Probe results are cached per process (all probes run concurrently)
+        status = _schema_status()
+        users_exists = status["users"]
+        history_exists = status["quiz_history"]
+        explanations_exists = status["explanations"]
+        text_hash_exists = status["explanations_text_hash"] or not explanations_exists
+        leaderboard_exists = status["leaderboard"]
+        drafts_exists = status["quiz_drafts"]
+        snapshots_exists = status["question_snapshots"]
             
         # Create missing tables using Supabase REST API
         if not users_exists:
@@ -76,7 +106,9 @@ CREATE TABLE public.quiz_history (
     date_time TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     duration TEXT,
     user_answers JSONB,
-    questions JSONB
+    questions JSONB,
+    snapshot_hash TEXT,
+    exam JSONB
 );
             """, language="sql")
             
@@ -88,20 +120,152 @@ CREATE TABLE public.explanations (
     user_name TEXT NOT NULL,
     explanation_key TEXT NOT NULL,
     explanation_text TEXT NOT NULL, 
+    text_hash TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     UNIQUE(user_name, explanation_key)
 );
             """, language="sql")
             
+        if not text_hash_exists:
+            st.warning("The 'explanations' table is missing the 'text_hash' column, so explanations cannot be saved. Please add it using the SQL Editor.")
+            st.code("""
+ALTER TABLE public.explanations ADD COLUMN IF NOT EXISTS text_hash TEXT;
+            """, language="sql")
+            
+        if not snapshots_exists:
+            st.warning("The 'question_snapshots' table doesn't exist in your Supabase project. Please create it using the SQL Editor.")
+            st.code("""
+CREATE TABLE public.question_snapshots (
+    hash TEXT PRIMARY KEY,
+    questions JSONB NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+ALTER TABLE public.quiz_history ADD COLUMN IF NOT EXISTS snapshot_hash TEXT REFERENCES public.question_snapshots(hash);
+ALTER TABLE public.quiz_history ADD COLUMN IF NOT EXISTS exam JSONB;
+            """, language="sql")
+            
+        if not leaderboard_exists:
+            st.warning("The 'leaderboard' table doesn't exist in your Supabase project. Please create it using the SQL Editor.")
+            st.code("""
+CREATE TABLE public.leaderboard (
+    user_name TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    quiz_set TEXT NOT NULL,
+    best_score FLOAT NOT NULL,
+    best_duration_seconds INTEGER,
+    best_date_time TIMESTAMP WITH TIME ZONE,
+    fastest_seconds INTEGER,
+    fastest_score FLOAT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_name, course_id, quiz_set)
+);
+CREATE INDEX idx_leaderboard_top_score ON public.leaderboard(course_id, quiz_set, best_score DESC, best_duration_seconds);
+CREATE INDEX idx_leaderboard_fastest ON public.leaderboard(course_id, quiz_set, fastest_seconds) WHERE fastest_seconds IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION public.merge_leaderboard_attempt(
+    p_user_name TEXT, p_course_id TEXT, p_quiz_set TEXT, p_score FLOAT,
+    p_duration_seconds INTEGER, p_completed BOOLEAN, p_date_time TIMESTAMP WITH TIME ZONE
+) RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO public.leaderboard AS lb (
+        user_name, course_id, quiz_set, best_score, best_duration_seconds, best_date_time,
+        fastest_seconds, fastest_score, attempts, updated_at
+    )
+    VALUES (
+        p_user_name, p_course_id, p_quiz_set, p_score, p_duration_seconds, p_date_time,
+        CASE WHEN p_completed THEN p_duration_seconds END,
+        CASE WHEN p_completed AND p_duration_seconds IS NOT NULL THEN p_score END,
+        1, NOW()
+    )
+    ON CONFLICT (user_name, course_id, quiz_set) DO UPDATE SET
+        attempts = lb.attempts + 1,
+        best_score = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+            AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+            THEN p_score ELSE lb.best_score END,
+        best_duration_seconds = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+            AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+            THEN p_duration_seconds ELSE lb.best_duration_seconds END,
+        best_date_time = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+            AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+            THEN p_date_time ELSE lb.best_date_time END,
+        fastest_seconds = CASE WHEN p_completed AND p_duration_seconds IS NOT NULL
+            AND (lb.fastest_seconds IS NULL OR p_duration_seconds < lb.fastest_seconds)
+            THEN p_duration_seconds ELSE lb.fastest_seconds END,
+        fastest_score = CASE WHEN p_completed AND p_duration_seconds IS NOT NULL
+            AND (lb.fastest_seconds IS NULL OR p_duration_seconds < lb.fastest_seconds)
+            THEN p_score ELSE lb.fastest_score END,
+        updated_at = NOW();
+$$;
+            """, language="sql")
+            
+        if not drafts_exists:
+            st.warning("The 'quiz_drafts' table doesn't exist in your Supabase project. Please create it using the SQL Editor.")
+            st.code("""
+CREATE TABLE public.quiz_drafts (
+    user_name TEXT PRIMARY KEY,
+    course_id TEXT NOT NULL,
+    quiz_set TEXT NOT NULL,
+    started_at DOUBLE PRECISION,
+    user_answers JSONB NOT NULL DEFAULT '{}'::jsonb,
+    exam JSONB,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION public.merge_quiz_draft(
+    p_user_name TEXT, p_course_id TEXT, p_quiz_set TEXT,
+    p_started_at DOUBLE PRECISION, p_changes JSONB, p_reset BOOLEAN, p_exam JSONB DEFAULT NULL
+) RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO public.quiz_drafts (user_name, course_id, quiz_set, started_at, user_answers, exam, updated_at)
+    VALUES (p_user_name, p_course_id, p_quiz_set, p_started_at, p_changes, p_exam, NOW())
+    ON CONFLICT (user_name) DO UPDATE SET
+        user_answers = CASE
+            WHEN p_reset OR quiz_drafts.course_id <> p_course_id OR quiz_drafts.quiz_set <> p_quiz_set
+                OR quiz_drafts.exam IS DISTINCT FROM p_exam
+            THEN p_changes
+            ELSE quiz_drafts.user_answers || p_changes
+        END,
+        course_id = p_course_id,
+        quiz_set = p_quiz_set,
+        exam = p_exam,
+        started_at = p_started_at,
+        updated_at = NOW();
+$$;
+            """, language="sql")
+            
         # If any table is missing, show error but don't prevent app from running
-        if not (users_exists and history_exists and explanations_exists):
+        if not (users_exists and history_exists and explanations_exists and text_hash_exists and snapshots_exists and leaderboard_exists and drafts_exists):
             st.info("Some database tables are missing. Please create them using the SQL provided above.")
+            # Probe again on the next run so newly created tables are picked up
+            _schema_status.clear()
             
         return True
     except Exception as e:
         st.error(f"Error checking database tables: {e}")
         return False
 
+# Probe name -> (table, column) queried to check that it exists
+SCHEMA_PROBES = {
+    "users": ("users", "*"),
+    "quiz_history": ("quiz_history", "*"),
+    "explanations": ("explanations", "*"),
+    "explanations_text_hash": ("explanations", "text_hash"),
+    "leaderboard": ("leaderboard", "user_name"),
+    "quiz_drafts": ("quiz_drafts", "user_name"),
+    "question_snapshots": ("question_snapshots", "hash"),
+}
+
+def _probe_table(table, column):
+    try:
+        get_supabase().table(table).select(column).limit(1).execute()
+        return True
+    except Exception:
+        return False
+
+@st.cache_resource(show_spinner=False)
+def _schema_status():
+    with ThreadPoolExecutor(max_workers=len(SCHEMA_PROBES)) as pool:
+        return dict(zip(SCHEMA_PROBES, pool.map(lambda probe: _probe_table(*probe), SCHEMA_PROBES.values())))
+
 # Function to load quiz data
 def load_quiz_data():
     try:
@@ -113,20 +277,1149 @@ def load_quiz_data():
         st.error(f"Error loading quiz data: {e}")
         return None
 
-# Update the load_history function to use the correct syntax for ordering
+# Shared quiz bank: one read-only copy per process instead of one per session
+@st.cache_resource(show_spinner=False)
+def get_quiz_bank():
+    return load_quiz_data()
+
+# Precompiled (course, quiz set) -> quiz lookup built once per bank load.
+# Quiz sets are keyed by str() because the database stores them as TEXT while
+# the bank may name them with numbers.
+@st.cache_resource(show_spinner=False)
+def _quiz_set_index():
+    index = {}
+    bank = get_quiz_bank()
+    for course in (bank or {}).get("course_ID", []):
+        for quiz in course["quiz_sets"]:
+            index.setdefault((course["course_ID"], str(quiz["quiz_set"])), quiz)
+    return index
+
+# Function to find a quiz set in the shared bank
+def get_quiz_set(course_id, quiz_set):
+    return _quiz_set_index().get((course_id, str(quiz_set)))
+
+class CompiledQuestion:
+    """Read-only question with widget labels, label lookup and answer set prebuilt"""
+
+    __slots__ = ("id", "text", "answer", "options", "labels", "label_to_key", "answer_set", "is_multiple", "source")
+
+    def __init__(self, question):
+        self.id = question["id"]
+        self.text = question["question"]
+        self.answer = question["answer"]
+        self.options = tuple(question["options"].items())
+        self.labels = tuple(f"{key}: {value}" for key, value in self.options)
+        self.label_to_key = {label: key for label, (key, _) in zip(self.labels, self.options)}
+        self.answer_set = frozenset(question["answer_number"])
+        self.is_multiple = len(question["answer_number"]) > 1
+        self.source = question
+
+    def is_correct(self, user_answer):
+        return frozenset(user_answer) == self.answer_set
+
+def compile_questions(questions):
+    return tuple(CompiledQuestion(question) for question in questions)
+
+# Compiled questions for every quiz set, built once per bank load
+@st.cache_resource(show_spinner=False)
+def _compiled_quiz_sets():
+    return {key: compile_questions(quiz["questions"]) for key, quiz in _quiz_set_index().items()}
+
+def get_compiled_questions(course_id, quiz_set):
+    return _compiled_quiz_sets().get((course_id, str(quiz_set)), ())
+
+# Function to drop the cached bank so every session picks up the new file
+def reload_quiz_bank():
+    get_quiz_bank.clear()
+    _quiz_set_index.clear()
+    _compiled_quiz_sets.clear()
+    _course_pools.clear()
+    get_exam_questions.clear()
+    _quiz_set_hashes.clear()
+
+# Quiz bank import pipeline
+QUIZ_IMPORT_CHUNK = 64 * 1024
+QUIZ_IMPORT_MAX_ERRORS = 50
+# The sidebar importer changes the bank for every session, so it is off unless enabled
+ALLOW_QUIZ_IMPORT = os.getenv("ALLOW_QUIZ_IMPORT", "").lower() in ("1", "true", "yes")
+
+@st.cache_resource(show_spinner=False)
+def _quiz_import_lock():
+    return threading.Lock()
+
+def iter_quiz_bank_courses(fp, extras=None):
+    """Yield course objects one at a time from a quiz bank JSON stream.
+
+    Only one course is decoded at a time; other top-level fields are
+    collected into ``extras`` when given.
+    """
+    decoder = json.JSONDecoder()
+    state = {"buf": "", "pos": 0, "eof": False}
+
+    def fill():
+        if state["eof"]:
+            return False
+        buf = state["buf"][state["pos"]:]
+        chunk = fp.read(max(QUIZ_IMPORT_CHUNK, len(buf)))
+        state["buf"], state["pos"] = buf + chunk, 0
+        if not chunk:
+            state["eof"] = True
+        return bool(chunk)
+
+    def next_char():
+        while True:
+            buf, pos = state["buf"], state["pos"]
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buf):
+                state["pos"] = pos + 1
+                return buf[pos]
+            if not fill():
+                raise ValueError("Unexpected end of quiz bank JSON")
+
+    def decode():
+        next_char()
+        state["pos"] -= 1
+        while True:
+            try:
+                value, end = decoder.raw_decode(state["buf"], state["pos"])
+                # A scalar ending exactly at the buffer edge may be truncated
+                if end < len(state["buf"]) or state["eof"]:
+                    state["pos"] = end
+                    return value
+            except json.JSONDecodeError:
+                if state["eof"]:
+                    raise
+            fill()
+
+    if next_char() != "{":
+        raise ValueError("Quiz bank must be a JSON object")
+    char = next_char()
+    while char != "}":
+        state["pos"] -= 1
+        key = decode()
+        if next_char() != ":":
+            raise ValueError("Malformed quiz bank JSON")
+        if key == "course_ID":
+            if next_char() != "[":
+                raise ValueError("'course_ID' must be a list of courses")
+            char = next_char()
+            while char != "]":
+                state["pos"] -= 1
+                yield decode()
+                char = next_char()
+                if char == ",":
+                    char = next_char()
+                elif char != "]":
+                    raise ValueError("Malformed 'course_ID' list")
+        else:
+            value = decode()
+            if extras is not None:
+                extras[key] = value
+        char = next_char()
+        if char == ",":
+            char = next_char()
+        elif char != "}":
+            raise ValueError("Malformed quiz bank JSON")
+
+def normalize_question(question, where, errors):
+    """Validate one question and return its normalized form (None if invalid)"""
+    if not isinstance(question, dict):
+        errors.append(f"{where}: question must be an object")
+        return None
+    q_id = question.get("id")
+    if isinstance(q_id, bool) or not isinstance(q_id, (int, float, str)) or q_id == "":
+        errors.append(f"{where}: missing or invalid 'id'")
+        return None
+    where = f"{where} question {q_id}"
+    text = question.get("question")
+    if not isinstance(text, str) or not text.strip():
+        errors.append(f"{where}: missing 'question' text")
+    options = question.get("options")
+    if not isinstance(options, dict) or not options:
+        errors.append(f"{where}: 'options' must be a non-empty object")
+        return None
+    options = {str(key).strip(): value for key, value in options.items()}
+    if not all(isinstance(value, str) for value in options.values()):
+        errors.append(f"{where}: option values must be strings")
+    answer_number = question.get("answer_number")
+    if isinstance(answer_number, str):
+        answer_number = [answer_number]
+    if not isinstance(answer_number, list) or not answer_number:
+        errors.append(f"{where}: 'answer_number' must be a non-empty list")
+        return None
+    answer_number = list(dict.fromkeys(str(key).strip() for key in answer_number))
+    unknown = [key for key in answer_number if key not in options]
+    if unknown:
+        errors.append(f"{where}: 'answer_number' {unknown} not in options {list(options)}")
+    answer = question.get("answer")
+    if not isinstance(answer, str) or not answer:
+        answer = " and ".join(str(options.get(key, key)) for key in answer_number)
+    return {
+        "id": q_id,
+        "question": text,
+        "options": options,
+        "answer": answer,
+        "answer_number": answer_number,
+    }
+
+def normalize_course(course, errors):
+    """Validate one course object and return its normalized form"""
+    if not isinstance(course, dict):
+        errors.append("Course entries must be objects")
+        return None
+    course_id = course.get("course_ID")
+    if not isinstance(course_id, str) or not course_id.strip():
+        errors.append("Course is missing 'course_ID'")
+        return None
+    course_id = course_id.strip()
+    quiz_sets = course.get("quiz_sets")
+    if not isinstance(quiz_sets, list):
+        errors.append(f"{course_id}: 'quiz_sets' must be a list")
+        return None
+    normalized_sets = []
+    for quiz in quiz_sets:
+        quiz_set = quiz.get("quiz_set") if isinstance(quiz, dict) else None
+        if quiz_set is None or quiz_set == "":
+            errors.append(f"{course_id}: quiz set is missing 'quiz_set'")
+            continue
+        # Quiz sets are used as dict keys and in labels, so only strings and integers are accepted
+        if isinstance(quiz_set, bool) or not isinstance(quiz_set, (str, int)):
+            errors.append(f"{course_id}: 'quiz_set' must be a string or integer, got {json.dumps(quiz_set)}")
+            continue
+        where = f"{course_id}/{quiz_set}"
+        questions = quiz.get("questions")
+        if not isinstance(questions, list) or not questions:
+            errors.append(f"{where}: 'questions' must be a non-empty list")
+            continue
+        seen_ids = set()
+        normalized_questions = []
+        for question in questions:
+            normalized = normalize_question(question, where, errors)
+            if normalized is None:
+                continue
+            if normalized["id"] in seen_ids:
+                errors.append(f"{where}: duplicate question id {normalized['id']}")
+            seen_ids.add(normalized["id"])
+            normalized_questions.append(normalized)
+        normalized_sets.append({"quiz_set": quiz_set, "questions": normalized_questions})
+    return {"course_ID": course_id, "quiz_sets": normalized_sets}
+
+def _merge_quiz_sets(base_sets, new_sets):
+    """Replace quiz sets with the same name and append new ones"""
+    new_names = {quiz["quiz_set"] for quiz in new_sets}
+    return [quiz for quiz in base_sets if quiz["quiz_set"] not in new_names] + list(new_sets)
+
+def import_quiz_banks(sources, merge=True):
+    """Validate, normalize and atomically swap uploaded quiz banks into DATA_FILE.
+
+    ``sources`` are binary or text file objects. Courses are streamed one at a
+    time into a spool file, so memory stays bounded by the largest course.
+    With ``merge`` the uploads are merged into the current bank (quiz sets with
+    the same name are replaced); otherwise they replace it. Raises ValueError
+    with every validation problem found, leaving DATA_FILE untouched.
+    """
+    errors = []
+    extras = {}
+    spool_offsets = {}
+    report = {"courses": 0, "quiz_sets": 0, "questions": 0}
+    data_dir = os.path.dirname(os.path.abspath(DATA_FILE))
+
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        # Pass 1: validate and spool normalized uploaded courses
+        for source in sources:
+            if source.seekable():
+                source.seek(0)
+            stream = io.TextIOWrapper(source, encoding="utf-8") if not isinstance(source, io.TextIOBase) else source
+            try:
+                for course in iter_quiz_bank_courses(stream, extras):
+                    normalized = normalize_course(course, errors)
+                    if normalized is None or errors:
+                        continue
+                    spool_offsets.setdefault(normalized["course_ID"], []).append(spool.tell())
+                    spool.write(json.dumps(normalized, ensure_ascii=False) + "\n")
+                    report["quiz_sets"] += len(normalized["quiz_sets"])
+                    report["questions"] += sum(len(quiz["questions"]) for quiz in normalized["quiz_sets"])
+            except ValueError as e:
+                errors.append(f"{getattr(source, 'name', 'upload')}: {e}")
+            finally:
+                if stream is not source:
+                    stream.detach()
+        if errors:
+            shown = "\n".join(errors[:QUIZ_IMPORT_MAX_ERRORS])
+            more = len(errors) - QUIZ_IMPORT_MAX_ERRORS
+            raise ValueError(shown + (f"\n... and {more} more" if more > 0 else ""))
+        if not spool_offsets:
+            raise ValueError("No courses found in the uploaded quiz bank")
+        report["courses"] = len(spool_offsets)
+
+        def load_uploaded(course_id):
+            course = None
+            for offset in spool_offsets[course_id]:
+                spool.seek(offset)
+                part = json.loads(spool.readline())
+                if course is None:
+                    course = part
+                else:
+                    course["quiz_sets"] = _merge_quiz_sets(course["quiz_sets"], part["quiz_sets"])
+            return course
+
+        # Pass 2: stream the merged bank into a temp file next to DATA_FILE
+        with _quiz_import_lock():
+            out = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=data_dir, suffix=".tmp", delete=False
+            )
+            try:
+                with out:
+                    out.write('{\n  "course_ID": [\n')
+                    first = True
+                    pending = list(spool_offsets)
+                    existing_extras = {}
+                    if merge and os.path.exists(DATA_FILE):
+                        with open(DATA_FILE, "r", encoding="utf-8") as existing:
+                            for course in iter_quiz_bank_courses(existing, existing_extras):
+                                if course.get("course_ID") in spool_offsets:
+                                    uploaded = load_uploaded(course["course_ID"])
+                                    course["quiz_sets"] = _merge_quiz_sets(course["quiz_sets"], uploaded["quiz_sets"])
+                                    pending.remove(course["course_ID"])
+                                out.write(("" if first else ",\n") + json.dumps(course, ensure_ascii=False, indent=2))
+                                first = False
+                    for course_id in pending:
+                        out.write(("" if first else ",\n") + json.dumps(load_uploaded(course_id), ensure_ascii=False, indent=2))
+                        first = False
+                    out.write("\n  ]")
+                    for key, value in {**existing_extras, **extras}.items():
+                        if key != "course_ID":
+                            out.write(f",\n  {json.dumps(key)}: {json.dumps(value, ensure_ascii=False, indent=2)}")
+                    out.write("\n}\n")
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.replace(out.name, DATA_FILE)
+            except Exception:
+                if os.path.exists(out.name):
+                    os.remove(out.name)
+                raise
+
+    reload_quiz_bank()
+    return report
+
+# Shared history rows, delta-synced and read by every session (history is visible to all users)
+HISTORY_COLUMNS = "id,user_name,course_id,quiz_set,score,total_questions,date_time,duration,user_answers,snapshot_hash,exam"
+HISTORY_PAGE_SIZE = 1000
+HISTORY_SYNC_MIN_INTERVAL = 2.0
+HISTORY_FULL_SYNC_INTERVAL = float(os.getenv("HISTORY_FULL_SYNC_INTERVAL", 600))
+
+@st.cache_resource(show_spinner=False)
+def _history_store():
+    return {
+        "lock": threading.Lock(), "rows": [], "by_id": {},
+        "cursor": None, "synced_at": 0.0, "full_synced_at": 0.0,
+    }
+
+def _set_history_rows(store, rows):
+    # Readers may still iterate the old list, so swap in new objects instead of mutating
+    store["rows"] = rows
+    store["by_id"] = {row["id"]: row for row in rows}
+    if rows:
+        store["cursor"] = (rows[0]["date_time"], rows[0]["id"])
+
+def sync_history(force_full=False):
+    """Fetch only rows newer than the newest (date_time, id) seen, then reuse the cache.
+
+    A full resync runs on first use and every HISTORY_FULL_SYNC_INTERVAL
+    seconds to pick up rows deleted by other app servers.
+    """
+    store = _history_store()
+    with store["lock"]:
+        now = time.monotonic()
+        full = force_full or store["cursor"] is None or now - store["full_synced_at"] >= HISTORY_FULL_SYNC_INTERVAL
+        if not full and now - store["synced_at"] < HISTORY_SYNC_MIN_INTERVAL:
+            return store["rows"]
+        
+        new_rows = []
+        while True:
+            query = get_supabase().table("quiz_history").select(HISTORY_COLUMNS)
+            if not full:
+                newest_date_time, newest_id = store["cursor"]
+                query = query.or_(
+                    f'date_time.gt."{newest_date_time}",'
+                    f'and(date_time.eq."{newest_date_time}",id.gt.{newest_id})'
+                )
+            page = (
+                query.order("date_time", desc=True).order("id", desc=True)
+                .range(len(new_rows), len(new_rows) + HISTORY_PAGE_SIZE - 1).execute().data or []
+            )
+            new_rows.extend(page)
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+        
+        if full:
+            _set_history_rows(store, new_rows)
+            store["full_synced_at"] = now
+        elif new_rows:
+            known = store["by_id"]
+            _set_history_rows(store, [row for row in new_rows if row["id"] not in known] + store["rows"])
+        store["synced_at"] = now
+        return store["rows"]
 
 def load_history():
     try:
         if st.session_state.user_authenticated:
-            # Get history from Supabase for ALL users
-            # Changed from .order("date_time", ascending=False) to .order("date_time", desc=True)
-            response = supabase.table("quiz_history").select("*").order("date_time", desc=True).execute()
-            return {"history": response.data if response.data else []}
+            return {"history": sync_history()}
         return {"history": []}
     except Exception as e:
         st.error(f"Error loading history: {e}")
         return {"history": []}
 
+# Function to drop a user's rows from the shared store after they clear their history
+def forget_history_rows(user_name):
+    store = _history_store()
+    with store["lock"]:
+        _set_history_rows(store, [row for row in store["rows"] if row.get("user_name") != user_name])
+
+# Function to resolve a history row by id from the shared store
+def get_history_entry(entry_id):
+    if entry_id is None:
+        return None
+    return _history_store()["by_id"].get(entry_id)
+
+# Question-set snapshots: each distinct quiz set is stored once, keyed by content hash
+SNAPSHOT_PAGE_SIZE = 200
+
+def quiz_set_hash(questions):
+    canonical = json.dumps(questions, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Content hash of each bank quiz set, computed once per bank load
+@st.cache_resource(show_spinner=False)
+def _quiz_set_hashes():
+    return {}
+
+def get_quiz_set_hash(course_id, quiz_set):
+    hashes = _quiz_set_hashes()
+    key = (course_id, str(quiz_set))
+    if key not in hashes:
+        quiz = get_quiz_set(course_id, quiz_set)
+        hashes[key] = quiz_set_hash(quiz["questions"]) if quiz else None
+    return hashes[key]
+
+# Snapshots are immutable, so resolved ones are cached for the whole process
+@st.cache_resource(show_spinner=False)
+def _snapshot_cache():
+    return {}
+
+def save_snapshot(questions):
+    """Store a question set once and return its hash (None if the table is unavailable)"""
+    snapshot_hash = quiz_set_hash(questions)
+    cache = _snapshot_cache()
+    if snapshot_hash in cache:
+        return snapshot_hash
+    try:
+        get_supabase().table("question_snapshots").upsert(
+            {"hash": snapshot_hash, "questions": questions},
+            on_conflict="hash",
+            ignore_duplicates=True
+        ).execute()
+    except Exception as e:
+        st.warning(f"Could not save question snapshot: {e}")
+        return None
+    cache[snapshot_hash] = questions
+    return snapshot_hash
+
+def get_snapshot(snapshot_hash):
+    cache = _snapshot_cache()
+    if snapshot_hash not in cache:
+        response = get_supabase().table("question_snapshots").select("questions").eq("hash", snapshot_hash).limit(1).execute()
+        if not response.data:
+            return None
+        cache[snapshot_hash] = response.data[0]["questions"]
+    return cache[snapshot_hash]
+
+# Function to get the questions of an attempt, inline (legacy rows) or from its snapshot
+def resolve_attempt_questions(entry):
+    if entry.get("questions"):
+        return entry["questions"]
+    if entry.get("exam"):
+        # Exam attempts only store their seed and question refs; rebuild them from the bank
+        return get_exam_questions(entry["course_id"], entry["exam"]["seed"], exam_refs_key(entry["exam"]["refs"]))[0]
+    try:
+        if entry.get("snapshot_hash"):
+            return get_snapshot(entry["snapshot_hash"]) or []
+        if _is_legacy_row(entry):
+            # Legacy row from the shared history store, which does not carry questions JSONB
+            prefetch_attempt_questions([entry])
+            snapshot_hash = _legacy_question_hashes().get(entry["id"])
+            return _snapshot_cache().get(snapshot_hash) or []
+    except Exception as e:
+        st.error(f"Error loading question snapshot: {e}")
+    return []
+
+# Function to get the content hash of an attempt's questions without re-serializing them
+def attempt_questions_hash(entry):
+    if entry.get("snapshot_hash"):
+        return entry["snapshot_hash"]
+    if entry.get("exam"):
+        return get_exam_questions(entry["course_id"], entry["exam"]["seed"], exam_refs_key(entry["exam"]["refs"]))[2]
+    if _is_legacy_row(entry):
+        return _legacy_question_hashes().get(entry["id"])
+    return None
+
+def _is_legacy_row(entry):
+    return not entry.get("snapshot_hash") and not entry.get("exam") and entry.get("id") is not None and "questions" not in entry
+
+# Legacy quiz_history id -> content hash of its inline questions (kept in the snapshot cache)
+@st.cache_resource(show_spinner=False)
+def _legacy_question_hashes():
+    return {}
+
+def prefetch_attempt_questions(entries, page_size=SNAPSHOT_PAGE_SIZE):
+    """Load the questions of many attempts with one query per table instead of one per row"""
+    cache = _snapshot_cache()
+    legacy = _legacy_question_hashes()
+    hashes = list({entry["snapshot_hash"] for entry in entries if entry.get("snapshot_hash")} - cache.keys())
+    ids = list({entry["id"] for entry in entries if _is_legacy_row(entry)} - legacy.keys())
+    for start in range(0, len(hashes), page_size):
+        response = get_supabase().table("question_snapshots").select("hash,questions").in_(
+            "hash", hashes[start:start + page_size]
+        ).execute()
+        for row in response.data or []:
+            cache[row["hash"]] = row["questions"]
+    for start in range(0, len(ids), page_size):
+        response = get_supabase().table("quiz_history").select("id,questions").in_(
+            "id", ids[start:start + page_size]
+        ).execute()
+        for row in response.data or []:
+            questions = row["questions"] or []
+            snapshot_hash = quiz_set_hash(questions)
+            cache.setdefault(snapshot_hash, questions)
+            legacy[row["id"]] = snapshot_hash
+
+def compact_history_snapshots(page_size=SNAPSHOT_PAGE_SIZE):
+    """Move inline questions JSONB of existing attempts into shared snapshots.
+
+    Rows are processed in id order; rows sharing a snapshot in a page are
+    updated with a single call. Returns counts of rows and snapshots touched.
+    """
+    report = {"rows": 0, "snapshots": set()}
+    last_id = 0
+    while True:
+        rows = (
+            get_supabase().table("quiz_history").select("id,questions")
+            .is_("snapshot_hash", "null").gt("id", last_id)
+            .order("id").limit(page_size).execute().data or []
+        )
+        if not rows:
+            break
+        ids_by_hash = {}
+        for row in rows:
+            if row.get("questions"):
+                snapshot_hash = save_snapshot(row["questions"])
+                if snapshot_hash is None:
+                    raise RuntimeError("question_snapshots table is not available")
+                ids_by_hash.setdefault(snapshot_hash, []).append(row["id"])
+        for snapshot_hash, ids in ids_by_hash.items():
+            get_supabase().table("quiz_history").update(
+                {"snapshot_hash": snapshot_hash, "questions": None}
+            ).in_("id", ids).execute()
+            report["rows"] += len(ids)
+            report["snapshots"].add(snapshot_hash)
+        last_id = rows[-1]["id"]
+        if len(rows) < page_size:
+            break
+    report["snapshots"] = len(report["snapshots"])
+    return report
+
+# History export for grading: keyset-paged reads streamed straight to disk
+EXPORT_PAGE_SIZE = 500
+EXPORT_COLUMNS = ["id", "user_name", "course_id", "quiz_set", "score", "total_questions", "date_time", "duration"]
+EXPORT_QUESTION_COLUMNS = ["question_id", "user_answer", "correct_answer", "is_correct"]
+
+# Prepared exports live in one directory; files older than this are swept on the next visit
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "quiz-history-exports")
+EXPORT_MAX_AGE_MINUTES = float(os.getenv("EXPORT_MAX_AGE_MINUTES", 30))
+
+# st.download_button accepts a callable for deferred downloads from Streamlit 1.52
+DEFERRED_DOWNLOADS = tuple(int(part) for part in st.__version__.split(".")[:2]) >= (1, 52)
+
+# Function to delete exports that were never downloaded (abandoned sessions, errors)
+def remove_stale_exports(max_age_minutes=EXPORT_MAX_AGE_MINUTES):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    cutoff = time.time() - max_age_minutes * 60
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+def iter_history_pages(columns, course_id=None, quiz_set=None, date_from=None, date_to=None, page_size=EXPORT_PAGE_SIZE):
+    """Yield pages of quiz_history rows ordered by id, paged on the server"""
+    last_id = 0
+    while True:
+        query = get_supabase().table("quiz_history").select(",".join(columns)).gt("id", last_id)
+        if course_id:
+            query = query.eq("course_id", course_id)
+        if quiz_set:
+            query = query.eq("quiz_set", quiz_set)
+        if date_from:
+            query = query.gte("date_time", date_from.isoformat())
+        if date_to:
+            query = query.lt("date_time", (date_to + datetime.timedelta(days=1)).isoformat())
+        rows = query.order("id").limit(page_size).execute().data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]["id"]
+
+def _flatten_attempt(row):
+    """Expand one attempt into one row per question with its correctness"""
+    user_answers = row.get("user_answers") or {}
+    base = {column: row.get(column) for column in EXPORT_COLUMNS}
+    for question in resolve_attempt_questions(row):
+        q_id = question["id"]
+        user_answer = user_answers.get(str(q_id), [])
+        correct_answer = question["answer_number"]
+        yield {
+            **base,
+            "question_id": str(q_id),
+            "user_answer": ",".join(user_answer),
+            "correct_answer": ",".join(correct_answer),
+            "is_correct": sorted(user_answer) == sorted(correct_answer),
+        }
+
+def export_history(path, fmt="csv", flatten=False, **filters):
+    """Export quiz_history to a CSV or Parquet file page by page.
+
+    Only one page of rows is held in memory at a time. With ``flatten`` each
+    attempt becomes one row per question. Returns the number of rows written.
+    """
+    columns = EXPORT_COLUMNS + (EXPORT_QUESTION_COLUMNS if flatten else [])
+    select_columns = EXPORT_COLUMNS + (["user_answers", "questions", "snapshot_hash", "exam"] if flatten else [])
+    written = 0
+
+    if fmt == "parquet":
+        pa = lazy_import("pyarrow")
+        pq = lazy_import("pyarrow.parquet")
+        types = {
+            "id": pa.int64(), "score": pa.float64(), "total_questions": pa.int64(),
+            "is_correct": pa.bool_(),
+        }
+        schema = pa.schema([(column, types.get(column, pa.string())) for column in columns])
+        with pq.ParquetWriter(path, schema) as writer:
+            for page in iter_history_pages(select_columns, **filters):
+                rows = [flat for row in page for flat in _flatten_attempt(row)] if flatten else page
+                table = pa.Table.from_pylist([{c: row.get(c) for c in columns} for row in rows], schema=schema)
+                writer.write_table(table)
+                written += len(rows)
+        return written
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for page in iter_history_pages(select_columns, **filters):
+            rows = [flat for row in page for flat in _flatten_attempt(row)] if flatten else page
+            writer.writerows(rows)
+            written += len(rows)
+    return written
+
+# Leaderboards: one row per user per quiz set, maintained at submission time
+LEADERBOARD_TOP_K = 10
+LEADERBOARD_UPSERT_CHUNK = 500
+
+def parse_duration(text):
+    """Inverse of format_duration: "1h 2m 3s" -> 3723 seconds (None if unparseable)"""
+    total = 0
+    units = {"h": 3600, "m": 60, "s": 1}
+    try:
+        for part in (text or "").split():
+            total += int(part[:-1]) * units[part[-1]]
+    except (ValueError, KeyError):
+        return None
+    return total if text else None
+
+def merge_leaderboard_attempt(row, score, duration_seconds, completed, date_time):
+    """Fold one attempt into a leaderboard row (best score, fastest completion, count)"""
+    row["attempts"] = row.get("attempts", 0) + 1
+    best_score = row.get("best_score")
+    best_duration = row.get("best_duration_seconds")
+    if (best_score is None or score > best_score or
+            (score == best_score and duration_seconds is not None and
+             (best_duration is None or duration_seconds < best_duration))):
+        row["best_score"] = score
+        row["best_duration_seconds"] = duration_seconds
+        row["best_date_time"] = date_time
+    fastest = row.get("fastest_seconds")
+    if completed and duration_seconds is not None and (fastest is None or duration_seconds < fastest):
+        row["fastest_seconds"] = duration_seconds
+        row["fastest_score"] = score
+    return row
+
+def record_leaderboard_attempt(user_name, course_id, quiz_set, score, duration_seconds, completed, date_time):
+    try:
+        # Merged in one SQL call so concurrent submissions cannot lose an attempt or a best score
+        get_supabase().rpc("merge_leaderboard_attempt", {
+            "p_user_name": user_name,
+            "p_course_id": course_id,
+            "p_quiz_set": str(quiz_set),
+            "p_score": score,
+            "p_duration_seconds": duration_seconds,
+            "p_completed": completed,
+            "p_date_time": date_time,
+        }).execute()
+    except Exception as e:
+        st.warning(f"Could not update leaderboard: {e}")
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_leaderboard(course_id, quiz_set, k=LEADERBOARD_TOP_K):
+    """Top-K best scores and fastest completions for a quiz set (two indexed O(K) reads)"""
+    def base():
+        return get_supabase().table("leaderboard").select(
+            "user_name,best_score,best_duration_seconds,best_date_time,fastest_seconds,fastest_score,attempts"
+        ).eq("course_id", course_id).eq("quiz_set", str(quiz_set))
+    top_scores = base().order("best_score", desc=True).order("best_duration_seconds").limit(k).execute().data or []
+    fastest = base().not_.is_("fastest_seconds", "null").order("fastest_seconds").limit(k).execute().data or []
+    return top_scores, fastest
+
+def backfill_leaderboard(page_size=EXPORT_PAGE_SIZE):
+    """Rebuild the leaderboard table from the whole quiz_history table"""
+    rows_by_key = {}
+    attempts = 0
+    columns = ["id", "user_name", "course_id", "quiz_set", "score", "total_questions", "date_time", "duration", "user_answers"]
+    for page in iter_history_pages(columns, page_size=page_size):
+        for attempt in page:
+            if attempt["quiz_set"] == EXAM_QUIZ_SET:
+                # Randomized exams are not comparable, so they are never ranked
+                continue
+            key = (attempt["user_name"], attempt["course_id"], str(attempt["quiz_set"]))
+            row = rows_by_key.setdefault(key, {"user_name": key[0], "course_id": key[1], "quiz_set": key[2]})
+            answered = sum(1 for answer in (attempt.get("user_answers") or {}).values() if answer)
+            merge_leaderboard_attempt(
+                row,
+                attempt["score"],
+                parse_duration(attempt.get("duration")),
+                bool(attempt.get("total_questions")) and answered >= attempt["total_questions"],
+                attempt.get("date_time")
+            )
+            attempts += 1
+    rows = list(rows_by_key.values())
+    for start in range(0, len(rows), LEADERBOARD_UPSERT_CHUNK):
+        get_supabase().table("leaderboard").upsert(
+            rows[start:start + LEADERBOARD_UPSERT_CHUNK], on_conflict="user_name,course_id,quiz_set"
+        ).execute()
+    return {"attempts": attempts, "rows": len(rows)}
+
+# Draft autosave: answer clicks only queue changes; a background thread writes them
+DRAFT_AUTOSAVE_INTERVAL = float(os.getenv("DRAFT_AUTOSAVE_INTERVAL", 5))
+
+class DraftAutosaver:
+    """Coalesces draft answer changes per user and writes at most once per interval"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_write = {}
+        self.client = None
+        self.last_error = None
+        self.thread = threading.Thread(target=self._run, name="draft-autosave", daemon=True)
+        self.thread.start()
+
+    def queue(self, client, user_name, course_id, quiz_set, started_at, changes, exam=None):
+        with self.lock:
+            self.client = client
+            draft = self.pending.get(user_name)
+            if draft is None or draft.get("delete") or \
+                    (draft["course_id"], draft["quiz_set"], draft["exam"]) != (course_id, quiz_set, exam):
+                # A new quiz set or exam (or a draft discarded since the last write) starts from scratch
+                reset = draft is not None
+                draft = {"course_id": course_id, "quiz_set": quiz_set, "exam": exam, "changes": {}, "reset": reset}
+                self.pending[user_name] = draft
+            draft["started_at"] = started_at
+            draft["changes"].update(changes)
+
+    def discard(self, client, user_name):
+        with self.lock:
+            self.client = client
+            self.pending[user_name] = {"delete": True}
+
+    def _write(self, client, user_name, draft):
+        if draft.get("delete"):
+            client.table("quiz_drafts").delete().eq("user_name", user_name).execute()
+            return
+        params = {
+            "p_user_name": user_name,
+            "p_course_id": draft["course_id"],
+            "p_quiz_set": str(draft["quiz_set"]),
+            "p_started_at": draft["started_at"],
+            "p_changes": draft["changes"],
+            "p_reset": draft["reset"],
+        }
+        if draft["exam"]:
+            # Only exam drafts need the migrated function signature
+            params["p_exam"] = draft["exam"]
+        client.rpc("merge_quiz_draft", params).execute()
+
+    def _run(self):
+        while True:
+            time.sleep(0.5)
+            now = time.monotonic()
+            with self.lock:
+                due = {
+                    user_name: draft for user_name, draft in self.pending.items()
+                    if now - self.last_write.get(user_name, 0) >= self.interval
+                }
+                for user_name in due:
+                    del self.pending[user_name]
+                    self.last_write[user_name] = now
+                client = self.client
+            for user_name, draft in due.items():
+                try:
+                    self._write(client, user_name, draft)
+                    self.last_error = None
+                except Exception as e:
+                    self.last_error = str(e)
+                    with self.lock:
+                        # Retry on the next tick unless newer changes superseded this draft
+                        newer = self.pending.get(user_name)
+                        if newer is None:
+                            self.pending[user_name] = draft
+                        elif not newer.get("delete") and not draft.get("delete") and not newer["reset"] and \
+                                (newer["course_id"], newer["quiz_set"], newer["exam"]) == \
+                                (draft["course_id"], draft["quiz_set"], draft["exam"]):
+                            newer["changes"] = {**draft["changes"], **newer["changes"]}
+                            newer["reset"] = draft["reset"]
+
+@st.cache_resource(show_spinner=False)
+def get_draft_autosaver():
+    return DraftAutosaver(DRAFT_AUTOSAVE_INTERVAL)
+
+def queue_draft_autosave():
+    """Queue answers changed since the last autosave of this session (no network I/O)"""
+    # An exam's draft also carries its seed and refs so it can be rebuilt on resume
+    exam = st.session_state.get("exam") if st.session_state.current_quiz_set == EXAM_QUIZ_SET else None
+    quiz_key = (st.session_state.current_course, st.session_state.current_quiz_set, exam and exam["seed"])
+    if st.session_state.get("draft_synced_for") != quiz_key:
+        st.session_state.draft_synced = {}
+        st.session_state.draft_synced_for = quiz_key
+    synced = st.session_state.draft_synced
+    changes = {
+        str(q_id): answer for q_id, answer in st.session_state.user_answers.items()
+        if synced.get(q_id, []) != answer
+    }
+    if not changes:
+        return
+    get_draft_autosaver().queue(
+        get_supabase(),
+        st.session_state.user_name,
+        st.session_state.current_course,
+        st.session_state.current_quiz_set,
+        st.session_state.quiz_start_time,
+        changes,
+        exam
+    )
+    synced.update({q_id: list(answer) for q_id, answer in st.session_state.user_answers.items()})
+
+def discard_draft():
+    st.session_state.draft_synced = {}
+    get_draft_autosaver().discard(get_supabase(), st.session_state.user_name)
+
+def load_draft(user_name):
+    response = get_supabase().table("quiz_drafts").select("*").eq("user_name", user_name).limit(1).execute()
+    draft = response.data[0] if response.data else None
+    if draft and any(draft.get("user_answers", {}).values()):
+        return draft
+    return None
+
+# Login: provision the user and prefetch the first screens in one parallel round-trip
+def provision_user(user_name):
+    get_supabase().table("users").upsert({"user_name": user_name}, on_conflict="user_name", ignore_duplicates=True).execute()
+
+# Supabase caps responses at 1000 rows; a full page means the key set may be incomplete
+EXPLANATION_KEY_PREFETCH_LIMIT = 1000
+
+def fetch_explanation_keys(user_name, course_id, quiz_set):
+    """Explanation keys stored for one quiz set (None if the result may be truncated)"""
+    prefix = f"{course_id}_{quiz_set}_"
+    response = get_supabase().table("explanations").select("explanation_key").in_(
+        "user_name", [SHARED_EXPLANATION_USER, user_name]
+    ).like("explanation_key", f"{prefix}%").limit(EXPLANATION_KEY_PREFETCH_LIMIT).execute()
+    rows = response.data or []
+    if len(rows) >= EXPLANATION_KEY_PREFETCH_LIMIT:
+        return None
+    # "_" is a LIKE wildcard, so check the prefix exactly
+    return {item["explanation_key"] for item in rows if item["explanation_key"].startswith(prefix)}
+
+def fetch_latest_attempt(user_name):
+    """The user's most recent practice attempt and the explanation keys stored for its quiz set"""
+    response = get_supabase().table("quiz_history").select("course_id,quiz_set").eq(
+        "user_name", user_name
+    ).neq("quiz_set", EXAM_QUIZ_SET).order("date_time", desc=True).limit(1).execute()
+    recent = response.data[0] if response.data else None
+    quiz = get_quiz_set(recent["course_id"], recent["quiz_set"]) if recent else None
+    if not quiz:
+        return None
+    # Use the bank's own quiz set value (quiz_history stores TEXT) so the selectbox matches
+    recent["quiz_set"] = quiz["quiz_set"]
+    recent["explanation_keys"] = fetch_explanation_keys(user_name, recent["course_id"], quiz["quiz_set"])
+    return recent
+
+def login_prefetch(user_name):
+    """Run the login round-trips concurrently; returns name -> result or exception"""
+    tasks = {
+        "user": lambda: provision_user(user_name),
+        "latest_attempt": lambda: fetch_latest_attempt(user_name),
+        "draft": lambda: load_draft(user_name),
+        "schema": _schema_status,
+        # Loads the bank (course list) and its compiled question sets
+        "courses": _compiled_quiz_sets,
+    }
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = {name: pool.submit(task) for name, task in tasks.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+    return results
+
+# Topic clustering: offline TF-IDF + spherical k-means per course, stored next to the bank
+TOPICS_FILE = "topics.json"
+TOPIC_MAX_DF = 0.8
+TOPIC_STOPWORDS = frozenset(
+    "a an and are as at be by can does for from how in is it of on or that the this to "
+    "what when which who why will with not following".split()
+)
+
+def _tfidf_matrix(texts):
+    """L2-normalized sublinear TF-IDF matrix (dense NumPy) and its term array"""
+    np = lazy_import("numpy")
+    vocab = {}
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        for token in re.findall(r"\w+", text.lower()):
+            if len(token) > 1 and not token.isdigit() and token not in TOPIC_STOPWORDS:
+                rows.append(row)
+                cols.append(vocab.setdefault(token, len(vocab)))
+    counts = np.zeros((len(texts), len(vocab)))
+    np.add.at(counts, (np.array(rows, dtype=int), np.array(cols, dtype=int)), 1)
+    doc_freq = (counts > 0).sum(axis=0)
+    keep = doc_freq <= max(1, TOPIC_MAX_DF * len(texts))
+    counts, doc_freq = counts[:, keep], doc_freq[keep]
+    terms = np.array(list(vocab), dtype=object)[keep]
+    matrix = np.log1p(counts) * (np.log((1 + len(texts)) / (1 + doc_freq)) + 1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms), terms
+
+def _spherical_kmeans(matrix, k, seed, iterations=100):
+    """Cosine k-means with k-means++ seeding; returns (labels, unit centroids)"""
+    np = lazy_import("numpy")
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    first = rng.integers(n)
+    centers = [first]
+    distance = 1 - matrix @ matrix[first]
+    for _ in range(1, k):
+        weights = np.clip(distance, 0, None)
+        total = weights.sum()
+        center = rng.choice(n, p=weights / total) if total > 0 else rng.integers(n)
+        centers.append(center)
+        distance = np.minimum(distance, 1 - matrix @ matrix[center])
+    centroids = matrix[centers]
+    labels = None
+    for _ in range(iterations):
+        new_labels = (matrix @ centroids.T).argmax(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        membership = np.zeros((n, k))
+        membership[np.arange(n), labels] = 1
+        centroids = membership.T @ matrix
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        centroids = centroids / np.where(norms == 0, 1, norms)
+    return labels, centroids
+
+def build_topic_index(clusters_per_course=None, seed=0):
+    """Cluster every course's questions and write the assignments to TOPICS_FILE"""
+    np = lazy_import("numpy")
+    index = {"courses": {}}
+    for course in (get_quiz_bank() or {}).get("course_ID", []):
+        quiz_sets, question_ids, texts = [], [], []
+        for quiz in course["quiz_sets"]:
+            for question in quiz["questions"]:
+                quiz_sets.append(str(quiz["quiz_set"]))
+                question_ids.append(str(question["id"]))
+                texts.append(question["question"] + " " + " ".join(question["options"].values()))
+        if len(texts) < 2:
+            continue
+        matrix, terms = _tfidf_matrix(texts)
+        k = clusters_per_course or int(np.clip(round(np.sqrt(len(texts) / 2)), 2, 12))
+        k = min(k, len(texts))
+        labels, centroids = _spherical_kmeans(matrix, k, seed)
+        top_terms = np.argsort(-centroids, axis=1)[:, :3]
+        sizes = np.bincount(labels, minlength=k)
+        index["courses"][course["course_ID"]] = {
+            "clusters": [
+                {"id": cluster, "label": ", ".join(terms[top_terms[cluster]]), "size": int(sizes[cluster])}
+                for cluster in range(k)
+            ],
+            "quiz_sets": quiz_sets,
+            "question_ids": question_ids,
+            "clusters_of": labels.tolist(),
+        }
+    
+    data_dir = os.path.dirname(os.path.abspath(TOPICS_FILE))
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=data_dir, suffix=".tmp", delete=False) as out:
+        json.dump(index, out, ensure_ascii=False)
+    os.replace(out.name, TOPICS_FILE)
+    get_topic_index.clear()
+    _course_pools.clear()
+    return {course_id: len(topics["clusters"]) for course_id, topics in index["courses"].items()}
+
+@st.cache_resource(show_spinner=False)
+def get_topic_index():
+    if os.path.exists(TOPICS_FILE):
+        with open(TOPICS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"courses": {}}
+
+def topic_accuracy_report(user_name, course_id):
+    """Per-topic accuracy of a user's attempts at a course (None if the course has no topics)"""
+    pd = lazy_import("pandas")
+    topics = get_topic_index()["courses"].get(course_id)
+    if not topics:
+        return None
+    attempts = [row for row in sync_history() if row.get("user_name") == user_name and row.get("course_id") == course_id]
+    
+    # Long-form answers and answer keys, compared and grouped with vectorized pandas ops
+    attempt_key = lambda row: row.get("snapshot_hash") or str(row["id"])
+    answers = pd.DataFrame(
+        [
+            (attempt_key(row), q_id, ",".join(sorted(answer)))
+            for row in attempts
+            for q_id, answer in (row.get("user_answers") or {}).items()
+        ],
+        columns=["attempt", "question_id", "user_answer"]
+    )
+    # Exam questions are numbered by position, so map them back to their source question
+    snapshots = {attempt_key(row): row for row in attempts}
+    prefetch_attempt_questions(list(snapshots.values()))
+    answer_keys = pd.DataFrame(
+        [
+            (
+                key,
+                str(question["id"]),
+                str(question.get("source_quiz_set", row["quiz_set"])),
+                str(question.get("source_id", question["id"])),
+                ",".join(sorted(question["answer_number"]))
+            )
+            for key, row in snapshots.items()
+            for question in resolve_attempt_questions(row)
+        ],
+        columns=["attempt", "question_id", "quiz_set", "source_id", "correct_answer"]
+    )
+    assignments = pd.DataFrame({
+        "quiz_set": topics["quiz_sets"],
+        "source_id": topics["question_ids"],
+        "cluster": topics["clusters_of"],
+    }).drop_duplicates(["quiz_set", "source_id"])
+    
+    graded = answers.merge(answer_keys, on=["attempt", "question_id"]).merge(assignments, on=["quiz_set", "source_id"])
+    graded["correct"] = graded["user_answer"] == graded["correct_answer"]
+    report = graded.groupby("cluster").agg(answered=("correct", "size"), correct=("correct", "sum"))
+    report["accuracy"] = report["correct"] / report["answered"] * 100
+    labels = pd.DataFrame(topics["clusters"]).set_index("id")
+    return labels.join(report, how="inner").sort_values("accuracy")
+
+# Exam mode: seeded, stratified draws across every quiz set of a course
+EXAM_QUIZ_SET = "Exam"
+EXAM_DEFAULT_QUESTIONS = 40
+EXAM_STRATA = {"Quiz set": "quiz_set", "Topic": "topic"}
+
+# Per-course pool of question refs and their strata, built once per bank load
+@st.cache_resource(show_spinner=False)
+def _course_pools():
+    topic_courses = get_topic_index()["courses"]
+    pools = {}
+    for course in (get_quiz_bank() or {}).get("course_ID", []):
+        topics = topic_courses.get(course["course_ID"], {})
+        topic_of = dict(zip(zip(topics.get("quiz_sets", []), topics.get("question_ids", [])), topics.get("clusters_of", [])))
+        refs, seen = [], set()
+        strata = {"quiz_set": {}, "topic": {}}
+        for quiz in course["quiz_sets"]:
+            for question in quiz["questions"]:
+                ref = (quiz["quiz_set"], question["id"])
+                if ref in seen:
+                    # Duplicate set names are only reachable through their first set
+                    continue
+                seen.add(ref)
+                strata["quiz_set"].setdefault(str(quiz["quiz_set"]), []).append(len(refs))
+                strata["topic"].setdefault(topic_of.get((str(quiz["quiz_set"]), str(question["id"])), -1), []).append(len(refs))
+                refs.append(ref)
+        pools[course["course_ID"]] = {"refs": refs, "strata": strata}
+    return pools
+
+def exam_pool_size(course_id):
+    return len(_course_pools().get(course_id, {"refs": []})["refs"])
+
+def sample_exam(course_id, count, seed, stratify="quiz_set"):
+    """Draw count question refs, allocated to strata in proportion to their size"""
+    pool = _course_pools().get(course_id)
+    if not pool or not pool["refs"]:
+        return []
+    rng = random.Random(seed)
+    strata = pool["strata"][stratify]
+    total = len(pool["refs"])
+    count = min(count, total)
+    
+    # Largest remainder allocation, ties broken by the seeded RNG
+    quotas = {stratum: count * len(members) / total for stratum, members in strata.items()}
+    allocation = {stratum: int(quota) for stratum, quota in quotas.items()}
+    remainders = sorted(quotas, key=lambda stratum: (quotas[stratum] - allocation[stratum], rng.random()), reverse=True)
+    for stratum in remainders[:count - sum(allocation.values())]:
+        allocation[stratum] += 1
+    
+    picked = []
+    for stratum in sorted(strata, key=str):
+        picked.extend(rng.sample(strata[stratum], allocation[stratum]))
+    rng.shuffle(picked)
+    return [list(pool["refs"][index]) for index in picked]
+
+def exam_refs_key(refs):
+    return tuple(tuple(ref) for ref in refs)
+
+# Exam questions rebuilt from (seed, refs), so attempts never store question text
+@st.cache_resource(show_spinner=False, max_entries=256)
+def get_exam_questions(course_id, seed, refs):
+    by_id = {}
+    questions = []
+    for position, (quiz_set, q_id) in enumerate(refs, start=1):
+        if quiz_set not in by_id:
+            quiz = get_quiz_set(course_id, quiz_set)
+            by_id[quiz_set] = {question["id"]: question for question in quiz["questions"]} if quiz else {}
+        source = by_id[quiz_set].get(q_id)
+        if source is None:
+            # Removed from the bank since the attempt; keep the other positions aligned
+            continue
+        # Option order is seeded per position, so it survives other questions being removed
+        keys = list(source["options"])
+        random.Random(f"{seed}:{position}").shuffle(keys)
+        questions.append({
+            **source,
+            "id": position,
+            "options": {key: source["options"][key] for key in keys},
+            "source_quiz_set": quiz_set,
+            "source_id": q_id,
+        })
+    return questions, compile_questions(questions), quiz_set_hash(questions)
+
+def new_exam(course_id, count, stratify):
+    seed = random.SystemRandom().randrange(2 ** 31)
+    return {"seed": seed, "stratify": stratify, "refs": sample_exam(course_id, count, seed, stratify)}
+
 # Function to save quiz history to Supabase
 def save_history(history):
     try:
@@ -137,19 +1430,44 @@ def save_history(history):
                     entry["user_name"] = st.session_state.user_name
                 
                 # Insert the record to Supabase
-                supabase.table("quiz_history").insert(entry).execute()
+                get_supabase().table("quiz_history").insert(entry).execute()
     except Exception as e:
         st.error(f"Error saving history: {e}")
 
-# Function to load explanations from Supabase
-def load_explanations():
+# Pre-written explanation packs (explanations.json) are shared by every user
+EXPLANATIONS_FILE = "explanations.json"
+SHARED_EXPLANATION_USER = "__shared__"
+EXPLANATION_UPSERT_CHUNK = 200
+
+def explanation_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Local read-only index of the shipped explanation pack, loaded once per process
+@st.cache_resource(show_spinner=False)
+def _local_explanations():
+    try:
+        if os.path.exists(EXPLANATIONS_FILE):
+            with open(EXPLANATIONS_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except Exception as e:
+        st.warning(f"Could not read {EXPLANATIONS_FILE}: {e}")
+    return {}
+
+# Function to load explanations from Supabase (the user's own ones override shared ones).
+# Pass keys to fetch only those rows instead of every shared pack explanation.
+def load_explanations(keys=None):
     try:
         if st.session_state.user_authenticated:
             # Get explanations from Supabase
-            response = supabase.table("explanations").select("*").eq("user_name", st.session_state.user_name).execute()
+            query = get_supabase().table("explanations").select("user_name,explanation_key,explanation_text").in_(
+                "user_name", [SHARED_EXPLANATION_USER, st.session_state.user_name]
+            )
+            if keys is not None:
+                query = query.in_("explanation_key", list(keys))
+            response = query.execute()
             if response.data:
                 explanations = {}
-                for item in response.data:
+                for item in sorted(response.data, key=lambda item: item["user_name"] != SHARED_EXPLANATION_USER):
                     explanations[item["explanation_key"]] = item["explanation_text"]
                 return explanations
         return {}
@@ -157,75 +1475,396 @@ def load_explanations():
         st.error(f"Error loading explanations: {e}")
         return {}
 
+def upsert_explanations(user_name, explanations, client=None):
+    """Write explanations with chunked multi-row upserts"""
+    client = client or get_supabase()
+    records = [
+        {
+            "user_name": user_name,
+            "explanation_key": key,
+            "explanation_text": text,
+            "text_hash": explanation_hash(text),
+        }
+        for key, text in explanations.items()
+    ]
+    for start in range(0, len(records), EXPLANATION_UPSERT_CHUNK):
+        client.table("explanations").upsert(
+            records[start:start + EXPLANATION_UPSERT_CHUNK], on_conflict="user_name,explanation_key"
+        ).execute()
+
 # Function to save explanations to Supabase
 def save_explanations(explanations):
     try:
         if st.session_state.user_authenticated:
-            for key, text in explanations.items():
-                try:
-                    # Try to insert first
-                    record = {
-                        "explanation_key": key,
-                        "explanation_text": text,
-                        "user_name": st.session_state.user_name
-                    }
-                    supabase.table("explanations").insert(record).execute()
-                except Exception as insert_error:
-                    if "23505" in str(insert_error):  # PostgreSQL duplicate key error
-                        # If duplicate key, update instead
-                        supabase.table("explanations").update(
-                            {"explanation_text": text}
-                        ).eq("user_name", st.session_state.user_name).eq("explanation_key", key).execute()
-                    else:
-                        # Re-raise other errors
-                        raise
+            upsert_explanations(st.session_state.user_name, explanations)
     except Exception as e:
         st.error(f"Error saving explanations: {e}")
 
-# Function to get explanation with caching
+def import_explanation_packs(paths, page_size=EXPORT_PAGE_SIZE):
+    """Bulk-load explanation packs into the shared explanation store.
+
+    Entries whose text hash matches the stored one are skipped. Later packs
+    override earlier ones for the same key. Returns counts of what was done.
+    """
+    pack = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            pack.update(json.load(f))
+
+    # Only keys and hashes are read back, never the stored texts
+    stored = {}
+    last_key = ""
+    while True:
+        rows = (
+            get_supabase().table("explanations").select("explanation_key,text_hash")
+            .eq("user_name", SHARED_EXPLANATION_USER).gt("explanation_key", last_key)
+            .order("explanation_key").limit(page_size).execute().data or []
+        )
+        stored.update((row["explanation_key"], row["text_hash"]) for row in rows)
+        if len(rows) < page_size:
+            break
+        last_key = rows[-1]["explanation_key"]
+
+    changed = {key: text for key, text in pack.items() if stored.get(key) != explanation_hash(text)}
+    if changed:
+        get_supabase().table("users").upsert(
+            {"user_name": SHARED_EXPLANATION_USER}, on_conflict="user_name", ignore_duplicates=True
+        ).execute()
+        upsert_explanations(SHARED_EXPLANATION_USER, changed)
+    return {
+        "total": len(pack),
+        "inserted": sum(1 for key in changed if key not in stored),
+        "updated": sum(1 for key in changed if key in stored),
+        "unchanged": len(pack) - len(changed),
+    }
+
+# Gemini client manager: one client and rate limiter per API key, shared by all sessions
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 15))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", 3))
+GEMINI_MAX_QUEUE_WAIT = float(os.getenv("GEMINI_MAX_QUEUE_WAIT", 60))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 4))
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_CAP = 30.0
+GEMINI_TRANSIENT_ERRORS = (
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "InternalServerError", "DeadlineExceeded",
+)
+
+class GeminiRateLimited(Exception):
+    """Raised when a call would wait longer than GEMINI_MAX_QUEUE_WAIT for its key"""
+
+class TokenBucket:
+    """Token bucket that queues callers in arrival order by reserving future tokens"""
+
+    def __init__(self, rate_per_minute, capacity):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > max_wait:
+                raise GeminiRateLimited(f"Gemini rate limit reached, try again in {wait:.0f}s")
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class GeminiClientManager:
+    """Per-key Gemini clients with rate limiting, jittered retries and token metering"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.buckets = {}
+        self.stats = {}
+
+    @staticmethod
+    def key_id(api_key):
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+    def _client(self, api_key):
+        with self.lock:
+            if api_key not in self.clients:
+                glm = lazy_import("google.ai.generativelanguage")
+                # One service client per key, so keys never share process-global configuration
+                self.clients[api_key] = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+                self.buckets[api_key] = TokenBucket(GEMINI_REQUESTS_PER_MINUTE, GEMINI_BURST)
+                self.stats[self.key_id(api_key)] = {
+                    "calls": 0, "errors": 0, "retries": 0, "queued_seconds": 0.0,
+                    "prompt_tokens": 0, "response_tokens": 0, "latency_seconds": 0.0,
+                }
+            return self.clients[api_key], self.buckets[api_key], self.stats[self.key_id(api_key)]
+
+    def generate(self, api_key, prompt):
+        client, bucket, stats = self._client(api_key)
+        glm = lazy_import("google.ai.generativelanguage")
+        request = glm.GenerateContentRequest(
+            model=f"models/{GEMINI_MODEL}",
+            contents=[glm.Content(role="user", parts=[glm.Part(text=prompt)])]
+        )
+        attempt = 0
+        while True:
+            queued = bucket.acquire(GEMINI_MAX_QUEUE_WAIT)
+            start = time.perf_counter()
+            try:
+                response = client.generate_content(request=request)
+                if not response.candidates or not response.candidates[0].content.parts:
+                    raise ValueError("Gemini returned no text (the response may have been blocked)")
+                text = "".join(part.text for part in response.candidates[0].content.parts)
+            except Exception as e:
+                transient = type(e).__name__ in GEMINI_TRANSIENT_ERRORS
+                with self.lock:
+                    stats["errors"] += 1
+                    stats["queued_seconds"] += queued
+                if not transient or attempt >= GEMINI_MAX_RETRIES:
+                    raise
+                attempt += 1
+                with self.lock:
+                    stats["retries"] += 1
+                time.sleep(random.uniform(0, min(GEMINI_BACKOFF_CAP, GEMINI_BACKOFF_BASE * 2 ** attempt)))
+                continue
+            usage = getattr(response, "usage_metadata", None)
+            with self.lock:
+                stats["calls"] += 1
+                stats["queued_seconds"] += queued
+                stats["latency_seconds"] += time.perf_counter() - start
+                stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+                stats["response_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+            return text
+
+    def usage_report(self, api_key):
+        with self.lock:
+            return dict(self.stats.get(self.key_id(api_key), {}))
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_manager():
+    return GeminiClientManager()
+
+# Background explanation jobs: persisted in SQLite, deduplicated by key, run by worker threads
+EXPLANATION_QUEUE_DB = os.getenv("EXPLANATION_QUEUE_DB", "explanation_jobs.db")
+EXPLANATION_WORKERS = int(os.getenv("EXPLANATION_WORKERS", 2))
+EXPLANATION_POLL_SECONDS = 2
+EXPLANATION_STALE_SECONDS = 300
+EXPLANATION_WORKER_BACKOFF_CAP = 30.0
+
+def explanation_error_message(error_message):
+    if "API key not available" in error_message or "invalid api key" in error_message.lower():
+        return "Invalid API key. Please enter a valid Google API key in the sidebar."
+    return "Sorry, could not generate explanation. Please check your API key or try again later."
+
+class ExplanationQueue:
+    """SQLite-backed explanation jobs processed by worker threads.
+
+    Jobs and results are stored on disk so finished explanations survive
+    reconnects. API keys are only held in memory, never written to the file.
+    """
+
+    def __init__(self, path, workers, manager):
+        self.path = path
+        self.manager = manager
+        self.secrets = {}
+        self.wakeup = threading.Condition()
+        self.last_error = None
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    key TEXT PRIMARY KEY,
+                    user_name TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        for number in range(workers):
+            threading.Thread(target=self._work, name=f"explanation-worker-{number}", daemon=True).start()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, key, user_name, api_key, prompt, client):
+        """Queue a job unless one is pending or done; returns (status, result)"""
+        with self._connect() as db:
+            row = db.execute("SELECT status, result FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row and row["status"] == "done":
+                return "done", row["result"]
+            if row and row["status"] in ("queued", "running") and key in self.secrets:
+                return row["status"], None
+            self.secrets[key] = (api_key, client)
+            db.execute("""
+                INSERT INTO jobs (key, user_name, prompt, status, created_at) VALUES (?, ?, ?, 'queued', ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    user_name = excluded.user_name, prompt = excluded.prompt, status = 'queued',
+                    error = NULL, created_at = excluded.created_at, started_at = NULL, finished_at = NULL
+            """, (key, user_name, prompt, time.time()))
+        with self.wakeup:
+            self.wakeup.notify()
+        return "queued", None
+
+    def status(self, key):
+        with self._connect() as db:
+            row = db.execute("SELECT status, result, error, created_at FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            if job["status"] == "queued":
+                job["position"] = db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (job["created_at"],)
+                ).fetchone()[0] + 1
+            return job
+
+    def stats(self, recent=50):
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            latency = db.execute("""
+                SELECT AVG(started_at - created_at), AVG(finished_at - started_at) FROM (
+                    SELECT created_at, started_at, finished_at FROM jobs
+                    WHERE status = 'done' ORDER BY finished_at DESC LIMIT ?
+                )
+            """, (recent,)).fetchone()
+        return {
+            "queued": counts.get("queued", 0), "running": counts.get("running", 0),
+            "done": counts.get("done", 0), "failed": counts.get("failed", 0),
+            "avg_wait_seconds": latency[0] or 0.0, "avg_run_seconds": latency[1] or 0.0,
+        }
+
+    def _claim(self):
+        # Only claim jobs whose API key this process holds
+        keys = list(self.secrets)
+        if not keys:
+            return None
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Jobs left running by a worker that hit an error are picked up again once stale
+            row = db.execute(
+                f"SELECT key, user_name, prompt FROM jobs "
+                f"WHERE (status = 'queued' OR (status = 'running' AND started_at < ?)) "
+                f"AND key IN ({','.join('?' * len(keys))}) ORDER BY created_at LIMIT 1",
+                [time.time() - EXPLANATION_STALE_SECONDS] + keys
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE key = ?",
+                    (time.time(), row["key"])
+                )
+            db.execute("COMMIT")
+            return row
+
+    def _finish(self, key, status, result=None, error=None):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE key = ?",
+                (status, result, error, time.time() if status != "queued" else None, key)
+            )
+
+    def _work(self):
+        failures = 0
+        while True:
+            try:
+                self._work_once()
+                failures = 0
+            except Exception as e:
+                # e.g. "database is locked": keep the worker alive and back off
+                failures += 1
+                self.last_error = f"Explanation worker error: {e}"
+                time.sleep(min(EXPLANATION_WORKER_BACKOFF_CAP, 2 ** failures))
+
+    def _work_once(self):
+        job = self._claim()
+        if job is None:
+            with self.wakeup:
+                self.wakeup.wait(timeout=1.0)
+            return
+        key = job["key"]
+        api_key, client = self.secrets[key]
+        try:
+            text = self.manager.generate(api_key, job["prompt"])
+        except GeminiRateLimited:
+            # Put it back in line; the key's bucket will have tokens again shortly
+            self._finish(key, "queued")
+            time.sleep(1)
+            return
+        except Exception as e:
+            self._finish(key, "failed", error=str(e))
+            self.secrets.pop(key, None)
+            return
+        # The API key is only dropped once the job is recorded, so a failed write can be retried
+        self._finish(key, "done", result=text)
+        self.secrets.pop(key, None)
+        try:
+            upsert_explanations(job["user_name"], {key: text}, client=client)
+        except Exception as e:
+            self.last_error = f"Could not save explanation {key}: {e}"
+
+@st.cache_resource(show_spinner=False)
+def get_explanation_queue():
+    return ExplanationQueue(EXPLANATION_QUEUE_DB, EXPLANATION_WORKERS, get_gemini_manager())
+
+def build_explanation_prompt(question, answer, options):
+    return f"""Giải thích khái niệm sau chi tiết bằng tiếng việt:
+        
+Question: {question}
+Options:
+{options}
+Correct Answer: {answer}
+
+Provide a comprehensive explanation of why this answer is correct, including relevant theories, definitions, 
+and examples if applicable. If this is a math problem, please explain the solution step by step.
+"""
+
+# Function to get explanation with caching (None means a background job was queued)
 def get_explanation(question, answer, options, question_id, course_id, quiz_set):
     # Create a unique key for this explanation
     explanation_key = f"{course_id}_{quiz_set}_{question_id}"
     
-    # Try to load from saved explanations first
-    explanations = load_explanations()
+    # Try to load from saved explanations first, unless the login prefetch already knows it is not stored
+    known = st.session_state.get("explanation_keys")
+    if not known or known["scope"] != (course_id, quiz_set) or explanation_key in known["keys"]:
+        explanations = load_explanations([explanation_key])
+        
+        if explanation_key in explanations:
+            return explanations[explanation_key]
     
-    if explanation_key in explanations:
-        return explanations[explanation_key]
+    # Fall back to the shipped explanation pack before calling Gemini
+    local_explanations = _local_explanations()
+    if explanation_key in local_explanations:
+        return local_explanations[explanation_key]
     
     # Check if API key is configured
     if not st.session_state.api_key:
         return "Please enter your Google API key in the sidebar to generate explanations."
     
-    # If not found, generate with API
+    # If not found, queue generation in the background (deduplicated by key)
     try:
-        # Configure the API with the user's key
-        genai.configure(api_key=st.session_state.api_key)
-        
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = f"""Giải thích khái niệm sau chi tiết bằng tiếng việt:
-        
-Question: {question}
-Options:
-{options}
-Correct Answer: {answer}
-
-Provide a comprehensive explanation of why this answer is correct, including relevant theories, definitions, 
-and examples if applicable. If this is a math problem, please explain the solution step by step.
-"""
-        response = model.generate_content(prompt)
-        explanation = response.text
-        
-        # Save to database
-        explanations[explanation_key] = explanation
-        save_explanations(explanations)
-        
-        return explanation
+        status, result = get_explanation_queue().enqueue(
+            explanation_key,
+            st.session_state.user_name,
+            st.session_state.api_key,
+            build_explanation_prompt(question, answer, options),
+            get_supabase()
+        )
+        return result if status == "done" else None
     except Exception as e:
-        error_message = str(e)
-        if "API key not available" in error_message or "invalid api key" in error_message.lower():
-            return "Invalid API key. Please enter a valid Google API key in the sidebar."
-        st.error(f"Error generating explanation: {e}")
+        st.error(f"Error queueing explanation: {e}")
         return "Sorry, could not generate explanation. Please check your API key or try again later."
 
 # Format duration function
@@ -241,17 +1880,44 @@ def format_duration(seconds):
     else:
         return f"{seconds}s"
 
+# Approximate deep size of a session value in bytes
+def _deep_sizeof(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    return size
+
+def session_memory_report():
+    """Return (key, bytes) pairs for the current session state, largest first"""
+    report = [(str(key), _deep_sizeof(value)) for key, value in st.session_state.items()]
+    return sorted(report, key=lambda item: item[1], reverse=True)
+
+def enforce_session_memory_budget():
+    """Evict rebuildable session entries until the session fits its memory budget"""
+    report = session_memory_report()
+    total = sum(size for _, size in report)
+    for key, size in report:
+        if total <= SESSION_MEMORY_BUDGET:
+            break
+        if key.startswith(EVICTABLE_SESSION_PREFIXES):
+            del st.session_state[key]
+            total -= size
+    if total > SESSION_MEMORY_BUDGET:
+        st.sidebar.warning(f"Session is using {total / 1024:.0f} KB, above the {SESSION_MEMORY_BUDGET / 1024:.0f} KB budget.")
+    return total
+
 # Function to initialize or reset session state
 def init_session_state():
     if 'route' not in st.session_state:
         st.session_state.route = 'login'  # Start with login screen
     
-    if 'quiz_data' not in st.session_state:
-        st.session_state.quiz_data = load_quiz_data()
-    
-    if 'course_data' not in st.session_state:
-        st.session_state.course_data = None
-    
     if 'current_course' not in st.session_state:
         st.session_state.current_course = None
         
@@ -264,9 +1930,6 @@ def init_session_state():
     if 'user_answers' not in st.session_state:
         st.session_state.user_answers = {}
         
-    if 'shuffled_questions' not in st.session_state:
-        st.session_state.shuffled_questions = None
-        
     if 'quiz_start_time' not in st.session_state:
         st.session_state.quiz_start_time = time.time()
     
@@ -282,17 +1945,11 @@ def init_session_state():
     if 'total_questions' not in st.session_state:
         st.session_state.total_questions = 0
     
-    if 'quiz_history' not in st.session_state:
-        st.session_state.quiz_history = load_history()
-        
-    if 'view_history_item' not in st.session_state:
-        st.session_state.view_history_item = None
-        
-    if 'history_view_index' not in st.session_state:
-        st.session_state.history_view_index = None
-        
-    if 'history' not in st.session_state:
-        st.session_state.history = load_history()
+    if 'history_view_id' not in st.session_state:
+        st.session_state.history_view_id = None
+    
+    if 'exam' not in st.session_state:
+        st.session_state.exam = None
 
 # Function to navigate to a different route
 def navigate_to(route):
@@ -330,6 +1987,9 @@ def nav_to_quiz():
 def nav_to_history():
     st.session_state.route = 'history'
 
+def nav_to_leaderboard():
+    st.session_state.route = 'leaderboard'
+
 # Main function for the entire app
 def main():
     # Setup the page
@@ -341,8 +2001,9 @@ def main():
     # Process any pending actions first
     process_pending_actions()
     
-    # Try to verify database tables exist
-    create_tables_if_needed()
+    # Try to verify database tables exist (skipped on the login page so it stays client-free)
+    if st.session_state.user_authenticated:
+        create_tables_if_needed()
     
     # Process any pending actions
     process_pending_actions()
@@ -398,7 +2059,7 @@ def main():
         st.sidebar.title("Navigation")
         
         # Use columns for navigation buttons
-        col1, col2 = st.sidebar.columns(2)
+        col1, col2, col3 = st.sidebar.columns(3)
         with col1:
             st.button("Quiz", on_click=nav_to_quiz, 
                       use_container_width=True,
@@ -407,6 +2068,10 @@ def main():
             st.button("History", on_click=nav_to_history,
                       use_container_width=True,
                       type="primary" if st.session_state.route in ['history', 'history_view'] else "secondary")
+        with col3:
+            st.button("Ranks", on_click=nav_to_leaderboard,
+                      use_container_width=True,
+                      type="primary" if st.session_state.route == 'leaderboard' else "secondary")
         
         # Add API Key input in sidebar
         st.sidebar.markdown("---")
@@ -433,6 +2098,38 @@ def main():
             "You need a Google API key with Gemini access to use the explanation feature. "
             "Get it from [Google AI Studio](https://makersuite.google.com/app/apikey)."
         )
+        
+        # Per-session memory usage report
+        total_bytes = enforce_session_memory_budget()
+        with st.sidebar.expander(f"Session memory: {total_bytes / 1024:.1f} KB"):
+            for key, size in session_memory_report()[:10]:
+                st.caption(f"{key}: {size / 1024:.1f} KB")
+        
+        # Gemini usage for the current API key
+        if st.session_state.api_key:
+            usage = get_gemini_manager().usage_report(st.session_state.api_key)
+            if usage:
+                with st.sidebar.expander("Gemini usage"):
+                    st.caption(f"Calls: {usage['calls']} (errors: {usage['errors']}, retries: {usage['retries']})")
+                    st.caption(f"Tokens: {usage['prompt_tokens']} prompt / {usage['response_tokens']} response")
+                    if usage["calls"]:
+                        st.caption(f"Avg latency: {usage['latency_seconds'] / usage['calls']:.2f}s, "
+                                   f"avg queue wait: {usage['queued_seconds'] / usage['calls']:.2f}s")
+        
+        # Background explanation queue depth and latency
+        queue_stats = get_explanation_queue().stats()
+        with st.sidebar.expander("Explanation queue"):
+            st.caption(f"Queued: {queue_stats['queued']}, running: {queue_stats['running']}")
+            st.caption(f"Done: {queue_stats['done']}, failed: {queue_stats['failed']}")
+            st.caption(f"Avg wait: {queue_stats['avg_wait_seconds']:.1f}s, "
+                       f"avg generation: {queue_stats['avg_run_seconds']:.1f}s")
+            if get_explanation_queue().last_error:
+                st.caption(f"Last error: {get_explanation_queue().last_error}")
+        
+        # Cold-start profile of lazily imported modules and clients
+        with st.sidebar.expander("Startup profile"):
+            for step, seconds in sorted(_startup_profile().items(), key=lambda item: item[1], reverse=True):
+                st.caption(f"{step}: {seconds * 1000:.0f} ms")
     
     # Route handler
     if st.session_state.route == 'login':
@@ -445,6 +2142,47 @@ def main():
         history_page()
     elif st.session_state.route == 'history_view':
         history_view_page()
+    elif st.session_state.route == 'leaderboard':
+        leaderboard_page()
+
+# Resume an autosaved attempt: restore answers, widget state and start time
+def resume_draft_callback():
+    draft = st.session_state.resume_draft
+    st.session_state.resume_draft = None
+    exam = draft.get("exam")
+    if exam:
+        # Exams are rebuilt from their seed and refs rather than looked up in the bank
+        quiz_set = EXAM_QUIZ_SET
+        questions = get_exam_questions(draft["course_id"], exam["seed"], exam_refs_key(exam["refs"]))[1]
+    else:
+        quiz_data = get_quiz_set(draft["course_id"], draft["quiz_set"])
+        if not quiz_data:
+            return
+        quiz_set = quiz_data["quiz_set"]
+        questions = get_compiled_questions(draft["course_id"], quiz_set)
+    st.session_state.current_course = draft["course_id"]
+    st.session_state.current_quiz_set = quiz_set
+    st.session_state.exam = exam
+    st.session_state.quiz_start_time = draft.get("started_at") or time.time()
+    st.session_state.user_answers = {}
+    for question in questions:
+        answer = draft["user_answers"].get(str(question.id), [])
+        if not answer:
+            continue
+        st.session_state.user_answers[question.id] = answer
+        if question.is_multiple:
+            for key in answer:
+                st.session_state[f"q_{question.id}_{key}"] = True
+        else:
+            labels = {key: label for label, key in question.label_to_key.items()}
+            if answer[0] in labels:
+                st.session_state[f"q_{question.id}"] = labels[answer[0]]
+    st.session_state.draft_synced = dict(st.session_state.user_answers)
+    st.session_state.draft_synced_for = (draft["course_id"], quiz_set, exam and exam["seed"])
+
+def discard_draft_callback():
+    st.session_state.resume_draft = None
+    discard_draft()
 
 # Quiz page
 def quiz_page():
@@ -458,21 +2196,20 @@ def quiz_page():
     )
     st.components.v1.html("<script>window.scrollTo(0, 0);</script>", height=0)
     # First check if quiz data is loaded
-    if not st.session_state.quiz_data:
+    bank = get_quiz_bank()
+    if not bank:
         st.info("No quiz data found. Please upload a quiz data file.")
         
         uploaded_file = st.file_uploader("Upload quiz data file", type=["json"])
         
         if uploaded_file is not None:
             try:
-                # Save the uploaded file
-                with open(DATA_FILE, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                
-                # Load the quiz data
-                st.session_state.quiz_data = load_quiz_data()
+                # Validate and atomically swap in the uploaded bank for all sessions
+                import_quiz_banks([uploaded_file], merge=False)
                 st.success("Successfully uploaded quiz data!")
                 st.rerun()
+            except ValueError as e:
+                st.error(f"Invalid quiz file:\n{e}")
             except Exception as e:
                 st.error(f"Error saving quiz file: {e}")
         
@@ -508,8 +2245,35 @@ def quiz_page():
         ''', language="json")
         return
     
+    # Offer to resume an unfinished attempt saved before a disconnect
+    draft = st.session_state.get("resume_draft")
+    if draft:
+        answered = sum(1 for answer in draft["user_answers"].values() if answer)
+        st.info(f"You have an unfinished attempt at {draft['course_id']} / {draft['quiz_set']} ({answered} answered).")
+        col1, col2, _ = st.columns([1, 1, 4])
+        col1.button("Resume", on_click=resume_draft_callback, use_container_width=True)
+        col2.button("Discard", on_click=discard_draft_callback, use_container_width=True)
+    
+    # Import additional quiz banks into the shared bank (admin deployments only)
+    if ALLOW_QUIZ_IMPORT:
+        with st.sidebar.expander("Import quiz bank"):
+            uploaded_files = st.file_uploader("Quiz bank files", type=["json"], accept_multiple_files=True)
+            import_mode = st.radio("Mode", ["Merge into current bank", "Replace current bank"])
+            if uploaded_files and st.button("Import"):
+                try:
+                    report = import_quiz_banks(uploaded_files, merge=import_mode.startswith("Merge"))
+                    st.success(
+                        f"Imported {report['courses']} course(s), {report['quiz_sets']} quiz set(s), "
+                        f"{report['questions']} question(s)."
+                    )
+                    bank = get_quiz_bank()
+                except ValueError as e:
+                    st.error(f"Invalid quiz file:\n{e}")
+                except Exception as e:
+                    st.error(f"Error importing quiz bank: {e}")
+    
     # Show course selection
-    courses = [course["course_ID"] for course in st.session_state.quiz_data["course_ID"]]
+    courses = [course["course_ID"] for course in bank["course_ID"]]
     
     selected_course = st.sidebar.selectbox(
         "Select Course", 
@@ -521,14 +2285,14 @@ def quiz_page():
     if selected_course != st.session_state.current_course:
         st.session_state.current_course = selected_course
         st.session_state.current_quiz_set = None
+        st.session_state.exam = None
         st.session_state.user_answers = {}
-        st.session_state.shuffled_questions = None
         st.session_state.quiz_start_time = time.time()
         st.rerun()
     
     # Find course data
     course_data = None
-    for course in st.session_state.quiz_data["course_ID"]:
+    for course in bank["course_ID"]:
         if course["course_ID"] == selected_course:
             course_data = course
             break
@@ -537,6 +2301,12 @@ def quiz_page():
         st.error("Course data not found!")
         return
     
+    # Exam mode draws a randomized, stratified set from every quiz set of the course
+    mode_index = 1 if st.session_state.current_quiz_set == EXAM_QUIZ_SET else 0
+    if st.sidebar.radio("Quiz mode", ["Practice", "Exam"], index=mode_index, horizontal=True) == "Exam":
+        exam_page(selected_course)
+        return
+    
     # Show quiz set selection
     quiz_sets = [quiz["quiz_set"] for quiz in course_data["quiz_sets"]]
     
@@ -549,8 +2319,8 @@ def quiz_page():
     # Update current quiz set if changed
     if selected_quiz_set != st.session_state.current_quiz_set:
         st.session_state.current_quiz_set = selected_quiz_set
+        st.session_state.exam = None
         st.session_state.user_answers = {}
-        st.session_state.shuffled_questions = None
         st.session_state.quiz_start_time = time.time()
         st.rerun()
     
@@ -569,28 +2339,87 @@ def quiz_page():
     st.markdown(f"**Course:** {selected_course}")
     st.markdown(f"**Quiz Set:** {selected_quiz_set}")
     
-    # Use original questions without shuffling
-    if st.session_state.shuffled_questions is None:
-        st.session_state.shuffled_questions = quiz_data["questions"]
+    # Use original questions without shuffling (precompiled from the shared bank)
+    questions = get_compiled_questions(selected_course, quiz_data["quiz_set"])
+    
+    render_questions(questions)
     
-    questions = st.session_state.shuffled_questions
+    # Autosave changed answers in the background (never blocks this rerun)
+    queue_draft_autosave()
+    autosave_error = get_draft_autosaver().last_error
+    if autosave_error:
+        st.caption(f"Autosave is retrying: {autosave_error}")
     
-    # Display quiz questions
+    # Submit button
+    col1, col2 = st.columns([1, 5])
+    with col1:
+        if st.button("Submit Quiz", use_container_width=True):
+            handle_button_action(
+                "submit_quiz",
+                course=selected_course,
+                quiz_set=selected_quiz_set,
+                route='result',
+                rerun=True
+            )
+
+def exam_page(course_id):
+    pool_size = exam_pool_size(course_id)
+    if not pool_size:
+        st.error("This course has no questions!")
+        return
+    
+    with st.sidebar.form("exam_settings"):
+        count = st.number_input("Questions", min_value=1, max_value=pool_size, value=min(EXAM_DEFAULT_QUESTIONS, pool_size))
+        stratify = st.radio("Balance by", list(EXAM_STRATA), horizontal=True)
+        start = st.form_submit_button("Start new exam", use_container_width=True)
+    
+    if start:
+        st.session_state.exam = new_exam(course_id, int(count), EXAM_STRATA[stratify])
+        st.session_state.current_quiz_set = EXAM_QUIZ_SET
+        st.session_state.user_answers = {}
+        st.session_state.quiz_start_time = time.time()
+        st.rerun()
+    
+    exam = st.session_state.exam
+    if not exam:
+        st.info("Choose the number of questions and start a new exam in the sidebar.")
+        return
+    
+    st.markdown(f"**Course:** {course_id}")
+    st.markdown(f"**Exam:** {len(exam['refs'])} questions from {pool_size}, seed {exam['seed']}")
+    
+    render_questions(get_exam_questions(course_id, exam["seed"], exam_refs_key(exam["refs"]))[1])
+    
+    # Autosave with the exam's seed and refs so a reconnect can rebuild it
+    queue_draft_autosave()
+    autosave_error = get_draft_autosaver().last_error
+    if autosave_error:
+        st.caption(f"Autosave is retrying: {autosave_error}")
+    
+    col1, col2 = st.columns([1, 5])
+    with col1:
+        if st.button("Submit Exam", use_container_width=True):
+            handle_button_action(
+                "submit_quiz",
+                course=course_id,
+                quiz_set=EXAM_QUIZ_SET,
+                route='result',
+                rerun=True
+            )
+
+# Function to render the answer widgets of compiled questions
+def render_questions(questions):
     st.markdown('<h2 class="sub-header">Questions</h2>', unsafe_allow_html=True)
     
     for question in questions:
-        q_id = question["id"]
-        st.markdown(f"#### Question {q_id}: {question['question']}")
+        q_id = question.id
+        st.markdown(f"#### Question {q_id}: {question.text}")
         
-        # Single or multiple choice
-        is_multiple = len(question["answer_number"]) > 1
-        
-        if not is_multiple:
+        if not question.is_multiple:
             # Single choice question
-            options = list(question["options"].items())
             choice = st.radio(
                 f"Options for Question {q_id}",
-                options=[f"{key}: {value}" for key, value in options],
+                options=question.labels,
                 key=f"q_{q_id}",
                 index=None,
                 label_visibility="collapsed"
@@ -598,19 +2427,17 @@ def quiz_page():
             
             # Process selection
             if choice:
-                selected_key = choice.split(":")[0].strip()
-                st.session_state.user_answers[q_id] = [selected_key]
+                st.session_state.user_answers[q_id] = [question.label_to_key[choice]]
             else:
                 st.session_state.user_answers[q_id] = []
         else:
             # Multiple choice question
             st.write("Select all that apply:")
-            options = list(question["options"].items())
             selections = []
             
-            for key, value in options:
+            for (key, _), label in zip(question.options, question.labels):
                 if st.checkbox(
-                    f"{key}: {value}",
+                    label,
                     key=f"q_{q_id}_{key}"
                 ):
                     selections.append(key)
@@ -618,19 +2445,6 @@ def quiz_page():
             st.session_state.user_answers[q_id] = selections
         
         st.markdown("---")
-    
-    # Submit button
-    col1, col2 = st.columns([1, 5])
-    with col1:
-        if st.button("Submit Quiz", use_container_width=True):
-            handle_button_action(
-                "submit_quiz",
-                questions=questions,
-                course=selected_course,
-                quiz_set=selected_quiz_set,
-                route='result',
-                rerun=True
-            )
 
 # Result page
 def result_page():
@@ -652,122 +2466,307 @@ def result_page():
     st.markdown(f'<div class="score-display">Your score: {st.session_state.score:.1f}%</div>', unsafe_allow_html=True)
     
     # Display review
+    exam = st.session_state.exam
+    if exam and st.session_state.current_quiz_set == EXAM_QUIZ_SET:
+        questions, _, questions_hash = get_exam_questions(st.session_state.current_course, exam["seed"], exam_refs_key(exam["refs"]))
+    else:
+        quiz_data = get_quiz_set(st.session_state.current_course, st.session_state.current_quiz_set)
+        questions = quiz_data["questions"] if quiz_data else []
+        questions_hash = get_quiz_set_hash(st.session_state.current_course, st.session_state.current_quiz_set)
     display_quiz_review(
-        st.session_state.shuffled_questions,
+        questions,
         st.session_state.user_answers,
         st.session_state.current_course,
-        st.session_state.current_quiz_set
+        st.session_state.current_quiz_set,
+        snapshot_hash=questions_hash
     )
     
     # Retake button
     if st.button("Retake Quiz"):
         handle_button_action("retake_quiz", route='quiz', rerun=True)
 
-# Function to display quiz review
-def display_quiz_review(questions, user_answers, course_id, quiz_set_id):
-    st.markdown('<h2 class="sub-header">Review</h2>', unsafe_allow_html=True)
-    
-    for question in questions:
-        q_id = question["id"]
-        
-        # Xử lý định dạng user_answers
-        if isinstance(user_answers, dict):
-            if str(q_id) in user_answers:
-                user_answer = user_answers[str(q_id)]
-            elif q_id in user_answers:
-                user_answer = user_answers[q_id]
-            else:
-                user_answer = []
-        else:
-            user_answer = []
-        
-        correct_answer = question["answer_number"]
-        
-        was_answered = len(user_answer) > 0
+# Pre-rendered review blocks, memoized by (quiz set hash, user answers) across sessions
+REVIEW_CACHE_SIZE = 256
+
+@st.cache_resource(show_spinner=False)
+def _review_block_cache():
+    return {"lock": threading.Lock(), "blocks": collections.OrderedDict()}
+
+# Function to get a user's answer list whether answers are keyed by str or int ids
+def _lookup_answer(user_answers, q_id):
+    if isinstance(user_answers, dict):
+        if str(q_id) in user_answers:
+            return user_answers[str(q_id)]
+        if q_id in user_answers:
+            return user_answers[q_id]
+    return []
+
+def render_review_blocks(questions, user_answers, snapshot_hash=None):
+    """Return one markdown/HTML block per question for the review page"""
+    answers_key = json.dumps(
+        {str(k): sorted(v) for k, v in (user_answers or {}).items()} if isinstance(user_answers, dict) else {},
+        sort_keys=True
+    )
+    cache_key = (snapshot_hash or quiz_set_hash(questions), answers_key)
+    cache = _review_block_cache()
+    with cache["lock"]:
+        if cache_key in cache["blocks"]:
+            cache["blocks"].move_to_end(cache_key)
+            return cache["blocks"][cache_key]
+    
+    blocks = []
+    for question in compile_questions(questions):
+        q_id = question.id
+        user_answer = _lookup_answer(user_answers, q_id)
         
-        if was_answered:
-            is_correct = sorted(user_answer) == sorted(correct_answer)
+        if user_answer:
+            is_correct = question.is_correct(user_answer)
             status_class = "correct" if is_correct else "incorrect"
             status_text = "Correct" if is_correct else "Incorrect"
         else:
             status_class = "unanswered"
             status_text = "Not answered"
         
-        col1, col2 = st.columns([10, 1])
+        lines = []
+        for key, value in question.options:
+            # Thay thế ký tự xuống dòng để HTML hiểu được
+            value_html = value.replace("\n", "<br>")
+            if key in question.answer_set:
+                option_class = "correct"
+            elif key in user_answer:
+                option_class = "incorrect"
+            else:
+                option_class = ""
+            class_attr = f' class="{option_class}"' if option_class else ""
+            lines.append(f'<div{class_attr} style="margin:0;">Option {key}: {value_html}</div>')
         
-        with col1:
-            st.markdown(f"#### Question {q_id}: {question['question']}")
-            st.markdown(f'<span class="{status_class}">{status_text}</span>', unsafe_allow_html=True)
-            
-            # Hiển thị các đáp án với xử lý xuống dòng
-            for key, value in question["options"].items():
-                # Thay thế ký tự xuống dòng để HTML hiểu được
-                value_html = value.replace("\n", "<br>")
-                is_user_selected = key in user_answer
-                is_correct_option = key in correct_answer
-                
-                if is_user_selected and is_correct_option:
-                    option_class = "correct"
-                elif is_user_selected and not is_correct_option:
-                    option_class = "incorrect"
-                elif not is_user_selected and is_correct_option:
-                    option_class = "correct"
-                else:
-                    option_class = ""
-                
-                if option_class:
-                    st.markdown(
-                        f'<div class="{option_class}" style="margin:0;">Option {key}: {value_html}</div>',
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f'<div style="margin:0;">Option {key}: {value_html}</div>',
-                        unsafe_allow_html=True
-                    )
+        blocks.append(
+            f"#### Question {q_id}: {question.text}\n\n"
+            f'<span class="{status_class}">{status_text}</span>\n\n'
+            + "\n".join(lines)
+        )
+    
+    with cache["lock"]:
+        cache["blocks"][cache_key] = blocks
+        while len(cache["blocks"]) > REVIEW_CACHE_SIZE:
+            cache["blocks"].popitem(last=False)
+    return blocks
+
+# Function to display quiz review
+def display_quiz_review(questions, user_answers, course_id, quiz_set_id, snapshot_hash=None):
+    st.markdown('<h2 class="sub-header">Review</h2>', unsafe_allow_html=True)
+    
+    # Static part of each question is pre-rendered
+    blocks = render_review_blocks(questions, user_answers, snapshot_hash)
+    
+    # Exam questions share explanations with the quiz set they were drawn from
+    sources = [(question.get("source_quiz_set", quiz_set_id), question.get("source_id", question["id"])) for question in questions]
+    
+    # One explain control for the whole review, kept in view in the sidebar
+    if questions:
+        with st.sidebar.expander("Explain a question", expanded=True):
+            position = st.selectbox(
+                "Question",
+                range(len(questions)),
+                format_func=lambda i: f"Question {questions[i]['id']}",
+                key=f"explain_choice_{course_id}_{quiz_set_id}"
+            )
+            if st.button("Explain", key=f"explain_{course_id}_{quiz_set_id}", use_container_width=True):
+                request_explanation(questions[position], course_id, *sources[position])
+    
+    # Runs of questions without an explanation are written as a single HTML block
+    run = []
+    after_explanation = False
+    for block, (source_quiz_set, q_id) in zip(blocks, sources):
+        explanation_key = f"explanation_{course_id}_{source_quiz_set}_{q_id}"
+        pending_key = f"pending_{explanation_key}"
+        run.append(block)
         
-        with col2:
-            explanation_key = f"explanation_{course_id}_{quiz_set_id}_{q_id}"
-            if st.button("Explain", key=f"explain_{course_id}_{quiz_set_id}_{q_id}"):
-                if not st.session_state.api_key:
-                    st.warning("Please enter your Google API key in the sidebar to use the explanation feature.")
-                else:
-                    options_text = "\n".join([f"{key}: {value}" for key, value in question["options"].items()])
-                    with st.spinner("Generating explanation..."):
-                        explanation = get_explanation(
-                            question["question"],
-                            question["answer"],
-                            options_text,
-                            q_id,
-                            course_id,
-                            quiz_set_id
-                        )
-                        st.session_state[explanation_key] = explanation
+        # Pick up finished background jobs
+        status_text = None
+        if pending_key in st.session_state:
+            job = get_explanation_queue().status(st.session_state[pending_key])
+            if job is None or job["status"] == "failed":
+                st.session_state[explanation_key] = explanation_error_message(job["error"] if job else "")
+                del st.session_state[pending_key]
+            elif job["status"] == "done":
+                st.session_state[explanation_key] = job["result"]
+                del st.session_state[pending_key]
+            elif job["status"] == "queued":
+                status_text = f"Explanation queued (position {job['position']})..."
+            else:
+                status_text = "Generating explanation..."
         
+        if status_text is None and explanation_key not in st.session_state:
+            continue
+        
+        _write_review_run(run, after_explanation)
+        run = []
+        after_explanation = True
+        if status_text:
+            st.caption(status_text)
         if explanation_key in st.session_state:
             st.markdown('<p class="explanation-header">Explanation:</p>', unsafe_allow_html=True)
             st.write(st.session_state[explanation_key])
-        
-        st.markdown("---")
+    
+    if run:
+        _write_review_run(run, after_explanation)
+    
+    # Refresh the page when a queued explanation finishes
+    if any(key.startswith("pending_explanation_") for key in st.session_state):
+        if hasattr(st, "fragment"):
+            st.fragment(run_every=EXPLANATION_POLL_SECONDS)(_poll_explanation_jobs)()
+        else:
+            st.button("Refresh explanations")
+
+def _write_review_run(blocks, after_explanation):
+    text = "\n\n---\n\n".join(blocks)
+    st.markdown(("---\n\n" + text) if after_explanation else text, unsafe_allow_html=True)
+
+# Function to request an explanation, either right away or as a background job
+def request_explanation(question, course_id, source_quiz_set, q_id):
+    explanation_key = f"explanation_{course_id}_{source_quiz_set}_{q_id}"
+    if not st.session_state.api_key:
+        st.warning("Please enter your Google API key in the sidebar to use the explanation feature.")
+        return
+    options_text = "\n".join([f"{key}: {value}" for key, value in question["options"].items()])
+    explanation = get_explanation(
+        question["question"],
+        question["answer"],
+        options_text,
+        q_id,
+        course_id,
+        source_quiz_set
+    )
+    if explanation is None:
+        st.session_state[f"pending_{explanation_key}"] = f"{course_id}_{source_quiz_set}_{q_id}"
+    else:
+        st.session_state[explanation_key] = explanation
+
+def _poll_explanation_jobs():
+    queue = get_explanation_queue()
+    for key in [key for key in st.session_state if key.startswith("pending_explanation_")]:
+        job = queue.status(st.session_state[key])
+        if job is None or job["status"] in ("done", "failed"):
+            st.rerun()
 
 # Update the history_page function to include filtering options
 
+def history_export_panel():
+    with st.expander("Export attempts for grading"):
+        remove_stale_exports()
+        bank = get_quiz_bank() or {"course_ID": []}
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            course_options = ["All Courses"] + [course["course_ID"] for course in bank["course_ID"]]
+            export_course = st.selectbox("Course", course_options, key="export_course")
+            export_format = st.radio("Format", ["CSV", "Parquet"], key="export_format", horizontal=True)
+        with col2:
+            set_options = ["All Quiz Sets"]
+            for course in bank["course_ID"]:
+                if course["course_ID"] == export_course:
+                    set_options += list(dict.fromkeys(str(quiz["quiz_set"]) for quiz in course["quiz_sets"]))
+            export_quiz_set = st.selectbox("Quiz Set", set_options, key="export_quiz_set")
+            flatten = st.checkbox("One row per question", key="export_flatten")
+        with col3:
+            date_range = st.date_input("Date range", value=(), key="export_dates")
+        
+        if st.button("Prepare export"):
+            fmt = export_format.lower()
+            fd, path = tempfile.mkstemp(suffix=f".{fmt}", dir=EXPORT_DIR)
+            os.close(fd)
+            previous = st.session_state.get("export_path")
+            if previous and os.path.exists(previous):
+                os.remove(previous)
+            try:
+                with st.spinner("Exporting quiz history..."):
+                    count = export_history(
+                        path,
+                        fmt=fmt,
+                        flatten=flatten,
+                        course_id=None if export_course == "All Courses" else export_course,
+                        quiz_set=None if export_quiz_set == "All Quiz Sets" else export_quiz_set,
+                        date_from=date_range[0] if len(date_range) > 0 else None,
+                        date_to=date_range[1] if len(date_range) > 1 else None,
+                    )
+                st.session_state.export_path = path
+                st.success(f"Exported {count} row(s).")
+            except Exception as e:
+                os.remove(path)
+                st.error(f"Error exporting history: {e}")
+        
+        export_path = st.session_state.get("export_path")
+        if export_path and os.path.exists(export_path):
+            file_name = f"quiz_history{os.path.splitext(export_path)[1]}"
+            if DEFERRED_DOWNLOADS:
+                # The file is only read when the download is requested, then deleted
+                st.download_button("Download export", _read_and_remove(export_path), file_name=file_name)
+            else:
+                # Older Streamlit: hand the file over once, so it is not held again on later reruns
+                data = _read_and_remove(export_path)()
+                del st.session_state.export_path
+                st.download_button("Download export", data, file_name=file_name)
+
+def _read_and_remove(path):
+    def read():
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    return read
+
+def topic_report_panel():
+    with st.expander("My weak topics"):
+        bank = get_quiz_bank() or {"course_ID": []}
+        courses = [course["course_ID"] for course in bank["course_ID"]]
+        if not courses:
+            return
+        course_id = st.selectbox(
+            "Course", courses, key="topic_report_course",
+            index=courses.index(st.session_state.current_course) if st.session_state.current_course in courses else 0
+        )
+        try:
+            report = topic_accuracy_report(st.session_state.user_name, course_id)
+        except Exception as e:
+            st.error(f"Error building topic report: {e}")
+            return
+        if report is None:
+            st.info("No topics computed for this course yet. Run `python manage.py cluster-topics`.")
+        elif report.empty:
+            st.info("No attempts at this course yet.")
+        else:
+            st.dataframe(
+                report[["label", "answered", "correct", "accuracy"]].rename(columns={
+                    "label": "Topic", "answered": "Answered", "correct": "Correct", "accuracy": "Accuracy (%)"
+                }),
+                hide_index=True,
+                use_container_width=True
+            )
+
 def history_page():
     # Display history list
     st.markdown('<h2 class="sub-header">Quiz History</h2>', unsafe_allow_html=True)
     
+    # Streaming export for instructors
+    history_export_panel()
+    
+    # Per-topic accuracy for the current user
+    topic_report_panel()
+    
     # Reload history to get fresh data
-    st.session_state.history = load_history()
+    history = load_history()
     
-    if not st.session_state.history["history"]:
+    if not history["history"]:
         st.info("No quiz history available yet.")
         return
     
     # Create a dataframe for the history
     history_data = []
-    for i, entry in enumerate(st.session_state.history["history"]):
+    for entry in history["history"]:
         history_data.append({
-            "Index": i,
+            "Id": entry.get("id"),
             "User": entry.get("user_name", "Unknown"),
             "Course": entry.get("course_id", ""),
             "Quiz Set": entry.get("quiz_set", ""),
@@ -776,6 +2775,7 @@ def history_page():
             "Duration": entry.get("duration", "")
         })
     
+    pd = lazy_import("pandas")
     history_df = pd.DataFrame(history_data)
     
     # Sort by date/time if present
@@ -838,7 +2838,7 @@ def history_page():
     # Rows - updated to include user
     for _, row in filtered_df.iterrows():
         cols = st.columns([2, 3, 2, 2, 3, 2, 1])
-        index = int(row["Index"])
+        entry_id = int(row["Id"])
         cols[0].write(row["User"])
         cols[1].write(row["Course"])
         cols[2].write(row["Quiz Set"])
@@ -846,8 +2846,8 @@ def history_page():
         cols[4].write(row["Date & Time"])
         cols[5].write(row["Duration"])
         
-        if cols[6].button("View", key=f"view_{index}"):
-            handle_button_action("view_history", index=index, route='history_view', rerun=True)
+        if cols[6].button("View", key=f"view_{entry_id}"):
+            handle_button_action("view_history", entry_id=entry_id, route='history_view', rerun=True)
     
     # Add clear history button only for the current user
     st.markdown("---")
@@ -858,16 +2858,60 @@ def history_page():
     with col2:
         st.caption("This will only clear your own quiz history, not others'.")
 
+# Leaderboard page
+def leaderboard_page():
+    st.markdown('<h2 class="sub-header">Leaderboard</h2>', unsafe_allow_html=True)
+    
+    bank = get_quiz_bank()
+    if not bank:
+        st.info("No quiz data found.")
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        courses = [course["course_ID"] for course in bank["course_ID"]]
+        selected_course = st.selectbox(
+            "Course", courses,
+            index=courses.index(st.session_state.current_course) if st.session_state.current_course in courses else 0
+        )
+    with col2:
+        quiz_sets = []
+        for course in bank["course_ID"]:
+            if course["course_ID"] == selected_course:
+                quiz_sets = list(dict.fromkeys(quiz["quiz_set"] for quiz in course["quiz_sets"]))
+        selected_quiz_set = st.selectbox("Quiz Set", quiz_sets)
+    
+    try:
+        top_scores, fastest = get_leaderboard(selected_course, selected_quiz_set)
+    except Exception as e:
+        st.error(f"Error loading leaderboard: {e}")
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("### Top Scores")
+        if not top_scores:
+            st.info("No attempts yet.")
+        for rank, row in enumerate(top_scores, start=1):
+            duration = row.get("best_duration_seconds")
+            st.write(f"{rank}. **{row['user_name']}** — {row['best_score']:.1f}%"
+                     + (f" in {format_duration(duration)}" if duration is not None else ""))
+    with col2:
+        st.write("### Fastest Completions")
+        if not fastest:
+            st.info("No completed attempts yet.")
+        for rank, row in enumerate(fastest, start=1):
+            st.write(f"{rank}. **{row['user_name']}** — {format_duration(row['fastest_seconds'])}"
+                     f" ({row['fastest_score']:.1f}%)")
+
 # History view page
 def history_view_page():
-    # Check if we have a valid history index
-    if st.session_state.history_view_index is None or len(st.session_state.history["history"]) <= st.session_state.history_view_index:
+    # Resolve the history entry from the shared store
+    entry = get_history_entry(st.session_state.history_view_id)
+    if entry is None:
         navigate_to('history')
         return
     
-    # Get the history entry
-    entry = st.session_state.history["history"][st.session_state.history_view_index]
-    
     # Back button
     if st.sidebar.button("Back to History"):
         handle_button_action("back_to_history", route='history', rerun=True)
@@ -885,10 +2929,11 @@ def history_view_page():
     
     # Display review
     display_quiz_review(
-        entry['questions'],
+        resolve_attempt_questions(entry),
         entry['user_answers'],
         entry['course_id'],
-        entry['quiz_set']
+        entry['quiz_set'],
+        snapshot_hash=attempt_questions_hash(entry)
     )
 
 # Replace the current handle_button_action function with this improved version:
@@ -906,29 +2951,27 @@ def handle_button_action(action_type, **kwargs):
             st.rerun()
             
         elif action_type == "view_history":
-            # Store index and change route immediately
-            history_index = kwargs.get("index")
-            st.session_state.history_view_index = history_index
+            # Store entry id and change route immediately
+            st.session_state.history_view_id = kwargs.get("entry_id")
             st.session_state.route = "history_view"
             st.rerun()
             
         elif action_type == "back_to_history":
-            st.session_state.history_view_index = None
+            st.session_state.history_view_id = None
             st.session_state.route = "history"
             st.rerun()
             
         elif action_type == "submit_quiz":
             # Store parameters for processing on next run
             st.session_state.pending_action = "submit_quiz"
-            st.session_state.pending_questions = kwargs.get("questions")
             st.session_state.pending_course = kwargs.get("course")
             st.session_state.pending_quiz_set = kwargs.get("quiz_set")
             st.session_state.route = "result"
             st.rerun()
         
         elif action_type == "retake_quiz":
+            discard_draft()
             st.session_state.user_answers = {}
-            st.session_state.shuffled_questions = None
             st.session_state.quiz_start_time = time.time()
             st.session_state.route = "quiz"
             st.rerun()
@@ -949,17 +2992,29 @@ def process_pending_actions():
     # Process user creation if needed
     if "pending_user_creation" in st.session_state:
         user_name = st.session_state.pending_user_creation
-        try:
-            # Check if user exists in Supabase
-            response = supabase.table("users").select("*").eq("user_name", user_name).execute()
-            
-            if not response.data:
-                # Create the user
-                supabase.table("users").insert({"user_name": user_name}).execute()
-        except Exception as e:
-            st.warning(f"Database error: {e}")
+        prefetched = login_prefetch(user_name)
+        
+        if isinstance(prefetched["user"], Exception):
+            st.warning(f"Database error: {prefetched['user']}")
             st.warning("User authentication failed. Some features may not work properly.")
         
+        # Offer to resume an unfinished attempt
+        draft = prefetched["draft"]
+        st.session_state.resume_draft = None if isinstance(draft, Exception) else draft
+        
+        # Open on the user's most recent quiz set and remember which of its explanations are stored
+        recent = prefetched["latest_attempt"]
+        if recent and not isinstance(recent, Exception):
+            if st.session_state.current_course is None:
+                st.session_state.current_course = recent["course_id"]
+                st.session_state.current_quiz_set = recent["quiz_set"]
+                st.session_state.quiz_start_time = time.time()
+            if recent["explanation_keys"] is not None:
+                st.session_state.explanation_keys = {
+                    "scope": (recent["course_id"], recent["quiz_set"]),
+                    "keys": frozenset(recent["explanation_keys"]),
+                }
+        
         # Clear the pending flag
         del st.session_state.pending_user_creation
     
@@ -972,9 +3027,11 @@ def process_pending_actions():
                 # Execute the actual deletion
                 if st.session_state.user_authenticated:
                     try:
-                        supabase.table("quiz_history").delete().eq("user_name", st.session_state.user_name).execute()
-                        # Reload history after clearing
-                        st.session_state.history = load_history()
+                        get_supabase().table("quiz_history").delete().eq("user_name", st.session_state.user_name).execute()
+                        get_supabase().table("leaderboard").delete().eq("user_name", st.session_state.user_name).execute()
+                        get_leaderboard.clear()
+                        # Drop the cleared rows from the shared history store
+                        forget_history_rows(st.session_state.user_name)
                         st.success("Your history has been cleared!")
                     except Exception as e:
                         st.error(f"Error clearing history: {e}")
@@ -982,27 +3039,27 @@ def process_pending_actions():
             elif action == "submit_quiz":
                 # Process quiz submission
                 try:
-                    questions = st.session_state.pending_questions
                     selected_course = st.session_state.pending_course
                     selected_quiz_set = st.session_state.pending_quiz_set
+                    exam = st.session_state.exam if selected_quiz_set == EXAM_QUIZ_SET else None
+                    if exam:
+                        questions, compiled, _ = get_exam_questions(selected_course, exam["seed"], exam_refs_key(exam["refs"]))
+                    else:
+                        questions = get_quiz_set(selected_course, selected_quiz_set)["questions"]
+                        compiled = get_compiled_questions(selected_course, selected_quiz_set)
                     
                     # Calculate duration
                     quiz_end_time = time.time()
                     quiz_duration = quiz_end_time - st.session_state.quiz_start_time
                     formatted_duration = format_duration(quiz_duration)
                     
-                    # Calculate score
+                    # Calculate score with the precompiled answer sets
                     total_questions = len(questions)
-                    correct_answers = 0
-                    
-                    for question in questions:
-                        q_id = question["id"]
-                        if q_id in st.session_state.user_answers:
-                            user_answer = sorted(st.session_state.user_answers[q_id])
-                            correct_answer = sorted(question["answer_number"])
-                            
-                            if user_answer == correct_answer:
-                                correct_answers += 1
+                    user_answers = st.session_state.user_answers
+                    correct_answers = sum(
+                        1 for question in compiled
+                        if question.id in user_answers and question.is_correct(user_answers[question.id])
+                    )
                     
                     score = (correct_answers / total_questions) * 100
                     st.session_state.score = score
@@ -1010,6 +3067,10 @@ def process_pending_actions():
                     # Prepare for history
                     json_user_answers = {str(k): v for k, v in st.session_state.user_answers.items()}
                     
+                    # Store the question set once as a snapshot; fall back to inline questions.
+                    # Exams store only their seed and refs and are rebuilt from the bank.
+                    snapshot_hash = None if exam else save_snapshot(questions)
+                    
                     # Create history entry
                     history_entry = {
                         "user_name": st.session_state.user_name,  # Make sure user name is included
@@ -1020,24 +3081,40 @@ def process_pending_actions():
                         "date_time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                         "duration": formatted_duration,
                         "user_answers": json_user_answers,
-                        "questions": questions
+                        "questions": None if snapshot_hash or exam else questions
                     }
+                    # Only reference the snapshot when it was saved, so the inline fallback
+                    # still inserts into databases without the snapshot_hash column
+                    if snapshot_hash:
+                        history_entry["snapshot_hash"] = snapshot_hash
+                    # Practice attempts never send the exam column
+                    if exam:
+                        history_entry["exam"] = exam
                     
-                    # Save to Supabase
+                    # Save to Supabase (history page reads it back through the shared store)
                     save_history({"history": [history_entry]})
                     
-                    # Also update local session state
-                    if "history" not in st.session_state.history:
-                        st.session_state.history = {"history": []}
-                    st.session_state.history["history"].append(history_entry)
+                    # Keep the leaderboard up to date incrementally; random exams are not comparable
+                    if not exam:
+                        record_leaderboard_attempt(
+                            st.session_state.user_name,
+                            selected_course,
+                            selected_quiz_set,
+                            round(score, 2),
+                            int(quiz_duration),
+                            all(st.session_state.user_answers.get(question["id"]) for question in questions),
+                            history_entry["date_time"]
+                        )
+                        get_leaderboard.clear()
+                    
+                    # The attempt is finished, so its draft is no longer needed
+                    discard_draft()
                     
                 except Exception as e:
                     st.error(f"Error processing quiz submission: {e}")
             
             # Clear pending actions to prevent reprocessing
             del st.session_state.pending_action
-            if "pending_questions" in st.session_state:
-                del st.session_state.pending_questions
             if "pending_course" in st.session_state:
                 del st.session_state.pending_course
             if "pending_quiz_set" in st.session_state:
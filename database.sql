@@ -8,6 +8,16 @@ CREATE TABLE public.users
     ()
 );
 
+    -- Create the question_snapshots table (one row per distinct quiz set, keyed by content hash)
+    CREATE TABLE public.question_snapshots
+    (
+        hash TEXT PRIMARY KEY,
+        questions JSONB NOT NULL,
+        created_at TIMESTAMP
+        WITH TIME ZONE DEFAULT NOW
+        ()
+);
+
     -- Create the quiz_history table
     CREATE TABLE public.quiz_history
     (
@@ -23,6 +33,8 @@ CREATE TABLE public.users
     duration TEXT,
     user_answers JSONB,
     questions JSONB,
+    snapshot_hash TEXT REFERENCES public.question_snapshots(hash),
+    exam JSONB,
     FOREIGN KEY
         (user_name) REFERENCES public.users
         (user_name) ON
@@ -36,6 +48,7 @@ CREATE TABLE public.users
             user_name TEXT NOT NULL,
             explanation_key TEXT NOT NULL,
             explanation_text TEXT NOT NULL,
+            text_hash TEXT,
             created_at TIMESTAMP
             WITH TIME ZONE DEFAULT NOW
             (),
@@ -46,16 +59,116 @@ CREATE TABLE public.users
     UNIQUE(user_name, explanation_key)
             );
 
+        -- Create the leaderboard table (best attempt per user per quiz set, updated on submit)
+        CREATE TABLE public.leaderboard
+        (
+            user_name TEXT NOT NULL,
+            course_id TEXT NOT NULL,
+            quiz_set TEXT NOT NULL,
+            best_score FLOAT NOT NULL,
+            best_duration_seconds INTEGER,
+            best_date_time TIMESTAMP
+            WITH TIME ZONE,
+            fastest_seconds INTEGER,
+            fastest_score FLOAT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP
+            WITH TIME ZONE DEFAULT NOW
+            (),
+    PRIMARY KEY
+            (user_name, course_id, quiz_set),
+    FOREIGN KEY
+            (user_name) REFERENCES public.users
+            (user_name) ON
+            DELETE CASCADE
+            );
+
+        -- Create the quiz_drafts table (autosaved in-progress attempt, one per user)
+        CREATE TABLE public.quiz_drafts
+        (
+            user_name TEXT PRIMARY KEY REFERENCES public.users(user_name) ON DELETE CASCADE,
+            course_id TEXT NOT NULL,
+            quiz_set TEXT NOT NULL,
+            started_at DOUBLE PRECISION,
+            user_answers JSONB NOT NULL DEFAULT '{}'::jsonb,
+            exam JSONB,
+            updated_at TIMESTAMP
+            WITH TIME ZONE DEFAULT NOW
+            ()
+);
+
+        -- Merge only the changed answers into a draft (replacing it when the quiz set or exam changes)
+        CREATE OR REPLACE FUNCTION public.merge_quiz_draft(
+            p_user_name TEXT, p_course_id TEXT, p_quiz_set TEXT,
+            p_started_at DOUBLE PRECISION, p_changes JSONB, p_reset BOOLEAN, p_exam JSONB DEFAULT NULL
+        ) RETURNS VOID LANGUAGE sql AS $$
+            INSERT INTO public.quiz_drafts (user_name, course_id, quiz_set, started_at, user_answers, exam, updated_at)
+            VALUES (p_user_name, p_course_id, p_quiz_set, p_started_at, p_changes, p_exam, NOW())
+            ON CONFLICT (user_name) DO UPDATE SET
+                user_answers = CASE
+                    WHEN p_reset OR quiz_drafts.course_id <> p_course_id OR quiz_drafts.quiz_set <> p_quiz_set
+                        OR quiz_drafts.exam IS DISTINCT FROM p_exam
+                    THEN p_changes
+                    ELSE quiz_drafts.user_answers || p_changes
+                END,
+                course_id = p_course_id,
+                quiz_set = p_quiz_set,
+                exam = p_exam,
+                started_at = p_started_at,
+                updated_at = NOW();
+        $$;
+
+        -- Fold one attempt into its leaderboard row atomically (same rules as merge_leaderboard_attempt in app.py)
+        CREATE OR REPLACE FUNCTION public.merge_leaderboard_attempt(
+            p_user_name TEXT, p_course_id TEXT, p_quiz_set TEXT, p_score FLOAT,
+            p_duration_seconds INTEGER, p_completed BOOLEAN, p_date_time TIMESTAMP WITH TIME ZONE
+        ) RETURNS VOID LANGUAGE sql AS $$
+            INSERT INTO public.leaderboard AS lb (
+                user_name, course_id, quiz_set, best_score, best_duration_seconds, best_date_time,
+                fastest_seconds, fastest_score, attempts, updated_at
+            )
+            VALUES (
+                p_user_name, p_course_id, p_quiz_set, p_score, p_duration_seconds, p_date_time,
+                CASE WHEN p_completed THEN p_duration_seconds END,
+                CASE WHEN p_completed AND p_duration_seconds IS NOT NULL THEN p_score END,
+                1, NOW()
+            )
+            ON CONFLICT (user_name, course_id, quiz_set) DO UPDATE SET
+                attempts = lb.attempts + 1,
+                best_score = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+                    AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+                    THEN p_score ELSE lb.best_score END,
+                best_duration_seconds = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+                    AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+                    THEN p_duration_seconds ELSE lb.best_duration_seconds END,
+                best_date_time = CASE WHEN p_score > lb.best_score OR (p_score = lb.best_score AND p_duration_seconds IS NOT NULL
+                    AND (lb.best_duration_seconds IS NULL OR p_duration_seconds < lb.best_duration_seconds))
+                    THEN p_date_time ELSE lb.best_date_time END,
+                fastest_seconds = CASE WHEN p_completed AND p_duration_seconds IS NOT NULL
+                    AND (lb.fastest_seconds IS NULL OR p_duration_seconds < lb.fastest_seconds)
+                    THEN p_duration_seconds ELSE lb.fastest_seconds END,
+                fastest_score = CASE WHEN p_completed AND p_duration_seconds IS NOT NULL
+                    AND (lb.fastest_seconds IS NULL OR p_duration_seconds < lb.fastest_seconds)
+                    THEN p_score ELSE lb.fastest_score END,
+                updated_at = NOW();
+        $$;
+
             -- Create indexes for better query performance
             CREATE INDEX idx_quiz_history_user_name ON public.quiz_history(user_name);
             CREATE INDEX idx_explanations_user_name ON public.explanations(user_name);
             CREATE INDEX idx_quiz_history_date_time ON public.quiz_history(date_time);
             CREATE INDEX idx_explanations_key ON public.explanations(explanation_key);
+            CREATE INDEX idx_leaderboard_top_score ON public.leaderboard(course_id, quiz_set, best_score DESC, best_duration_seconds);
+            CREATE INDEX idx_leaderboard_fastest ON public.leaderboard(course_id, quiz_set, fastest_seconds) WHERE fastest_seconds IS NOT NULL;
+            CREATE INDEX idx_quiz_history_unsnapshotted ON public.quiz_history(id) WHERE snapshot_hash IS NULL;
 
             -- Enable Row Level Security (RLS)
             ALTER TABLE public.users ENABLE ROW LEVEL SECURITY;
             ALTER TABLE public.quiz_history ENABLE ROW LEVEL SECURITY;
             ALTER TABLE public.explanations ENABLE ROW LEVEL SECURITY;
+            ALTER TABLE public.question_snapshots ENABLE ROW LEVEL SECURITY;
+            ALTER TABLE public.leaderboard ENABLE ROW LEVEL SECURITY;
+            ALTER TABLE public.quiz_drafts ENABLE ROW LEVEL SECURITY;
 
             -- Create RLS policies for the users table
             CREATE POLICY "Allow insert for authenticated users" 
@@ -117,6 +230,39 @@ ON public.explanations FOR
             INSERT TO anon WITH CHECK (
             true);
 
+            CREATE POLICY "Allow anonymous select on question_snapshots" 
+ON public.question_snapshots FOR
+            SELECT TO anon
+            USING
+            (true);
+
+            CREATE POLICY "Allow anonymous insert on question_snapshots" 
+ON public.question_snapshots FOR
+            INSERT TO anon WITH CHECK (
+            true);
+
+            CREATE POLICY "Allow anonymous access on leaderboard" 
+ON public.leaderboard
+FOR ALL TO anon
+USING
+            (true);
+
+            CREATE POLICY "Allow anonymous access on quiz_drafts" 
+ON public.quiz_drafts
+FOR ALL TO anon
+USING
+            (true);
+
+            -- Migrating an existing database: add the snapshot column, then run
+            -- `python manage.py compact-snapshots` with a service-role SUPABASE_KEY
+            -- ALTER TABLE public.quiz_history ADD COLUMN IF NOT EXISTS snapshot_hash TEXT REFERENCES public.question_snapshots(hash);
+            -- ALTER TABLE public.explanations ADD COLUMN IF NOT EXISTS text_hash TEXT;
+            -- ALTER TABLE public.quiz_history ADD COLUMN IF NOT EXISTS exam JSONB;
+            -- ALTER TABLE public.quiz_drafts ADD COLUMN IF NOT EXISTS exam JSONB;
+            -- DROP FUNCTION IF EXISTS public.merge_quiz_draft(TEXT, TEXT, TEXT, DOUBLE PRECISION, JSONB, BOOLEAN);
+            -- then re-create public.merge_quiz_draft from above so exam drafts can be resumed
+            -- Existing leaderboards also need public.merge_leaderboard_attempt from above
+
             -- Create a storage bucket for quiz data
             INSERT INTO storage.buckets
                 (id, name, public)
@@ -0,0 +1,96 @@
+"""Maintenance commands for FE Learning.
+
+Usage: python manage.py <command>
+"""
+import argparse
+
+import app
+
+
+def compact_snapshots(args):
+    report = app.compact_history_snapshots(page_size=args.page_size)
+    print(f"Compacted {report['rows']} attempt(s) into {report['snapshots']} snapshot(s).")
+
+
+def backfill_leaderboard(args):
+    report = app.backfill_leaderboard(page_size=args.page_size)
+    print(f"Rebuilt {report['rows']} leaderboard row(s) from {report['attempts']} attempt(s).")
+
+
+def import_explanations(args):
+    report = app.import_explanation_packs(args.files)
+    print(
+        f"{report['total']} explanation(s): {report['inserted']} inserted, "
+        f"{report['updated']} updated, {report['unchanged']} unchanged."
+    )
+
+
+def import_quiz_bank(args):
+    sources = [open(path, "rb") for path in args.files]
+    try:
+        report = app.import_quiz_banks(sources, merge=not args.replace)
+    except ValueError as e:
+        raise SystemExit(f"Invalid quiz file:\n{e}")
+    finally:
+        for source in sources:
+            source.close()
+    print(
+        f"Imported {report['courses']} course(s), {report['quiz_sets']} quiz set(s), "
+        f"{report['questions']} question(s) into {app.DATA_FILE}."
+    )
+
+
+def cluster_topics(args):
+    report = app.build_topic_index(clusters_per_course=args.clusters, seed=args.seed)
+    for course_id, clusters in report.items():
+        print(f"{course_id}: {clusters} topic(s)")
+    print(f"Wrote {app.TOPICS_FILE}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FE Learning maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact = commands.add_parser(
+        "compact-snapshots",
+        help="Move inline questions of existing attempts into question_snapshots"
+    )
+    compact.add_argument("--page-size", type=int, default=app.SNAPSHOT_PAGE_SIZE)
+    compact.set_defaults(handler=compact_snapshots)
+
+    backfill = commands.add_parser(
+        "backfill-leaderboard",
+        help="Rebuild the leaderboard table from quiz_history"
+    )
+    backfill.add_argument("--page-size", type=int, default=app.EXPORT_PAGE_SIZE)
+    backfill.set_defaults(handler=backfill_leaderboard)
+
+    explanations = commands.add_parser(
+        "import-explanations",
+        help="Bulk-load explanation packs into the shared explanation store"
+    )
+    explanations.add_argument("files", nargs="*", default=[app.EXPLANATIONS_FILE])
+    explanations.set_defaults(handler=import_explanations)
+
+    quiz_bank = commands.add_parser(
+        "import-quiz-bank",
+        help="Validate quiz bank files and merge them into the quiz data file"
+    )
+    quiz_bank.add_argument("files", nargs="+")
+    quiz_bank.add_argument("--replace", action="store_true", help="Replace the current bank instead of merging")
+    quiz_bank.set_defaults(handler=import_quiz_bank)
+
+    topics = commands.add_parser(
+        "cluster-topics",
+        help="Cluster each course's questions into topics for the weak-topic report"
+    )
+    topics.add_argument("--clusters", type=int, default=None, help="Topics per course (default: sqrt(n/2))")
+    topics.add_argument("--seed", type=int, default=0)
+    topics.set_defaults(handler=cluster_topics)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()